@@ -5,49 +5,825 @@
 # Installation
 # sudo apt-get install python-pip python-dev
 # sudo pip2 install pykafka Flask
+import atexit
+import importlib
+import json
+import logging
 import os
+import signal
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
 
 from pykafka import KafkaClient
-from flask import Flask, request, Response
+from pykafka.common import CompressionType, OffsetType
+from pykafka.partitioners import hashing_partitioner, random_partitioner
+from pykafka.exceptions import KafkaException, NoBrokersAvailableError, SocketDisconnectedError
+from flask import Flask, request, Response, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.serving import make_server
 
-kafka_connect_path = os.path.realpath(os.path.dirname(__file__) + '/etc/kafka.connect')
-with open(kafka_connect_path, "r") as connect_file:
-    KAFKA_CONNECT = connect_file.read()
+from reuseport import listen_socket
+from spool import Spool, SpoolFullError
+
+KAFKA_CONNECT_PATH = os.path.realpath(os.path.dirname(__file__) + '/etc/kafka.connect')
+PRODUCER_MODE = os.environ.get('PRODUCER_MODE', 'sync')
+PRODUCER_POOL_SIZE = int(os.environ.get('PRODUCER_POOL_SIZE', 4))
+PRODUCER_OPTIONS = {
+    'compression': getattr(CompressionType, os.environ.get('COMPRESSION', 'none').upper()),
+}
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+# Seconds to wait for Kafka to acknowledge a batch before it is spooled.
+DELIVERY_TIMEOUT = 30
+ASYNC_PRODUCER_OPTIONS = {
+    'linger_ms': int(os.environ.get('LINGER_MS', 100)),
+    'min_queued_messages': MAX_BATCH_SIZE,
+    'required_acks': int(os.environ.get('REQUIRED_ACKS', 1)),
+}
+PARTITIONER = os.environ.get('PARTITIONER', 'hashing')
+CONSUMER_TTL = int(os.environ.get('CONSUMER_TTL', 300))
+MAX_POLL_MESSAGES = 10000
+MAX_POLL_TIMEOUT_MS = 30000
+CHUNK_SIZE = 64 * 1024
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+# Maximum size of a message after gunzipping: the body of POST /<topic> or
+# a line of POST /<topic>/batch.
+MAX_BODY_SIZE = int(os.environ.get('MAX_BODY_SIZE_MB', 16)) * 1024 * 1024
+WORKER = int(os.environ.get('WORKER', 0))
+WORKERS = int(os.environ.get('WORKERS', 1))
+# Every worker process has a spool of its own.
+SPOOL_DIR = os.environ.get('SPOOL_DIR', os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), 'spool', str(WORKER)))
+# Seconds between looking for the spools of removed workers.
+ADOPT_INTERVAL = 10
+SPOOL_MAX_SIZE_MB = int(os.environ.get('SPOOL_MAX_SIZE_MB', 1024))
+SPOOL_MAX_AGE_HOURS = int(os.environ.get('SPOOL_MAX_AGE_HOURS', 24))
+# Errors after which a message is spooled instead of delivered: broker
+# errors, and socket errors and a missing kafka.connect while the relation
+# is being (re)configured.
+DELIVERY_ERRORS = (KafkaException, EnvironmentError)
+PORT = int(os.environ.get('PORT', 5000))
 
 APP = Flask(__name__)
 
+
+class RoutedKey(bytes):
+    """A message key that also pins the message to partition
+    `partition_id`."""
+    def __new__(cls, key, partition_id):
+        routed = super(RoutedKey, cls).__new__(cls, key)
+        routed.partition_id = partition_id
+        return routed
+
+
+class RoutingPartitioner(object):
+    """Sends messages with a `RoutedKey` to its partition, keyed messages to
+    the partition `partitioner` picks and other messages to a random
+    partition."""
+    def __init__(self, partitioner):
+        self.partitioner = partitioner
+
+    def __call__(self, partitions, key):
+        partition_id = getattr(key, 'partition_id', None)
+        if partition_id is not None:
+            for partition in partitions:
+                if partition.id == partition_id:
+                    return partition
+            raise ValueError("Topic has no partition {}".format(partition_id))
+        if not key:
+            return random_partitioner(partitions, key)
+        return self.partitioner(partitions, key)
+
+
+def load_partitioner(name):
+    """Returns the partitioner called `name`: 'hashing', 'random' or the
+    import path of a callable, eg. 'mypackage.partitioners:by_region'."""
+    if name == 'hashing':
+        return hashing_partitioner
+    if name == 'random':
+        return random_partitioner
+    module_name, _, attribute = name.partition(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+class Kafka(object):
+    """Process-wide KafkaClient with cached topics, a pool of sync producers
+    per topic and one shared batching producer per topic for `deliver()`.
+    The client is rebuilt when the contents of `connect_path` change."""
+    check_interval = 1
+
+    def __init__(self, connect_path, pool_size, producer_options=None, async_options=None,
+                 partitioner=None):
+        self.connect_path = connect_path
+        self.pool_size = pool_size
+        self.partitioner = RoutingPartitioner(partitioner or hashing_partitioner)
+        self.producer_options = producer_options or {}
+        self.async_options = async_options or {}
+        self.generation = 0
+        self._client = None
+        self._hosts = None
+        self._mtime = None
+        self._checked = 0
+        self._topics = {}
+        self._producers = {}
+        self._batch_producers = {}
+        self._lock = threading.RLock()
+
+    def _reconnect_if_changed(self):
+        now = time.time()
+        if self._client and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        mtime = os.stat(self.connect_path).st_mtime
+        if self._client and mtime == self._mtime:
+            return
+        with open(self.connect_path, "r") as connect_file:
+            hosts = connect_file.read().strip()
+        self._mtime = mtime
+        if self._client and hosts == self._hosts:
+            return
+        self._close()
+        self._hosts = hosts
+        self._client = KafkaClient(hosts=hosts)
+
+    def _close(self):
+        for producer in self._batch_producers.values():
+            # Blocks until the queued messages are delivered.
+            producer.stop()
+        self._batch_producers = {}
+        for pool in self._producers.values():
+            while True:
+                try:
+                    pool.get_nowait().stop()
+                except Empty:
+                    break
+        self._producers = {}
+        self._topics = {}
+        self._client = None
+        # Producers checked out before are stopped instead of returned.
+        self.generation += 1
+
+    def topic(self, name):
+        with self._lock:
+            self._reconnect_if_changed()
+            topic = self._topics.get(name)
+            if topic is None:
+                topic = self._topics[name] = self._client.topics[name.encode('UTF-8')]
+            return topic
+
+    def reset(self):
+        """Stops all producers and drops the client; the next call connects
+        again."""
+        with self._lock:
+            self._close()
+
+    @contextmanager
+    def producer(self, name):
+        """Checks a sync producer for topic `name` out of the pool. Producers
+        that raised are stopped instead of returned; connection errors also
+        drop the client."""
+        topic = self.topic(name)
+        with self._lock:
+            generation = self.generation
+            pool = self._producers.setdefault(name, Queue(self.pool_size))
+        try:
+            producer = pool.get_nowait()
+        except Empty:
+            producer = topic.get_sync_producer(
+                partitioner=self.partitioner, **self.producer_options)
+        try:
+            yield producer
+        except BaseException as exc:
+            producer.stop()
+            if isinstance(exc, (NoBrokersAvailableError, SocketDisconnectedError, EnvironmentError)):
+                self.reset()
+            raise
+        if generation != self.generation:
+            producer.stop()
+            return
+        try:
+            pool.put_nowait(producer)
+        except Full:
+            producer.stop()
+
+    def _batch_producer(self, name):
+        with self._lock:
+            producer = self._batch_producers.get(name)
+            if producer is None:
+                producer = self._batch_producers[name] = self.topic(name).get_producer(
+                    sync=False, delivery_reports=True, partitioner=self.partitioner,
+                    **dict(self.producer_options, **self.async_options))
+            return producer
+
+    def deliver(self, messages, timeout):
+        """Produces a batch of (topic, value, partition key) tuples and waits
+        at most `timeout` seconds per message until Kafka acknowledged them.
+        Raises the first delivery error; the producers involved are then
+        stopped, so some messages of the batch may still be delivered."""
+        producers = {}
+        try:
+            for topic, value, key in messages:
+                producer = producers.get(topic) or self._batch_producer(topic)
+                producers[topic] = producer
+                producer.produce(value, partition_key=key)
+            # Delivery reports are kept per producing thread.
+            for topic, value, key in messages:
+                _, exc = producers[topic].get_delivery_report(timeout=timeout)
+                if exc is not None:
+                    raise exc
+        except BaseException as exc:
+            with self._lock:
+                for topic, producer in producers.items():
+                    if self._batch_producers.get(topic) is producer:
+                        del self._batch_producers[topic]
+            for producer in producers.values():
+                producer.stop()
+            if isinstance(exc, (NoBrokersAvailableError, SocketDisconnectedError, EnvironmentError)):
+                self.reset()
+            raise
+
+
+KAFKA = Kafka(
+    KAFKA_CONNECT_PATH, PRODUCER_POOL_SIZE, PRODUCER_OPTIONS, ASYNC_PRODUCER_OPTIONS,
+    load_partitioner(PARTITIONER))
+
+
+class GroupConsumer(object):
+    """A managed balanced consumer of one topic for one consumer group.
+    `lock` is held from the start of a poll until its offsets are
+    committed."""
+    def __init__(self, consumer, generation):
+        self.consumer = consumer
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+    def poll(self, max_messages, timeout_ms):
+        """Returns up to `max_messages` messages. Waits at most `timeout_ms`
+        for the first message, then returns what is already fetched."""
+        deadline = time.time() + timeout_ms / 1000.0
+        messages = []
+        while len(messages) < max_messages:
+            message = self.consumer.consume()
+            if message is not None:
+                messages.append(message)
+            elif messages or time.time() >= deadline:
+                break
+        self.last_used = time.time()
+        return messages
+
+
+class ConsumerCache(object):
+    """Keeps one `GroupConsumer` per topic and consumer group. Consumers
+    that are not polled for `ttl` seconds are stopped by `evict_idle()` so
+    their partitions go to the other members of the group."""
+    consume_timeout_ms = 100
+
+    def __init__(self, kafka, ttl):
+        self.kafka = kafka
+        self.ttl = ttl
+        self._consumers = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, topic, group):
+        """Returns the locked consumer of `topic` for `group`. Hand it back
+        with `checkin()`."""
+        intopic = self.kafka.topic(topic)
+        stale = None
+        with self._lock:
+            entry = self._consumers.get((topic, group))
+            if entry is None or entry.generation != self.kafka.generation:
+                stale = entry
+                entry = self._consumers[(topic, group)] = GroupConsumer(
+                    intopic.get_balanced_consumer(
+                        consumer_group=group.encode('UTF-8'),
+                        managed=True,
+                        auto_commit_enable=False,
+                        consumer_timeout_ms=self.consume_timeout_ms),
+                    self.kafka.generation)
+            entry.last_used = time.time()
+        if stale:
+            self._stop(stale)
+        entry.lock.acquire()
+        return entry
+
+    def checkin(self, entry, failed=False):
+        """Commits the offsets of the polled messages. When delivering them
+        failed, the consumer is stopped instead so the group resumes from
+        the last committed offsets."""
+        try:
+            if not failed:
+                entry.consumer.commit_offsets()
+                return
+            with self._lock:
+                for key, value in list(self._consumers.items()):
+                    if value is entry:
+                        del self._consumers[key]
+            entry.consumer.stop()
+        finally:
+            entry.lock.release()
+
+    def _stop(self, entry):
+        with entry.lock:
+            entry.consumer.stop()
+
+    def evict_idle(self):
+        deadline = time.time() - self.ttl
+        with self._lock:
+            evicted = [(key, entry) for key, entry in self._consumers.items()
+                       if entry.last_used < deadline]
+            for key, _ in evicted:
+                del self._consumers[key]
+        for _, entry in evicted:
+            self._stop(entry)
+        return len(evicted)
+
+    def start_evicting(self):
+        def evict_forever():
+            while True:
+                time.sleep(max(1, self.ttl / 2))
+                self.evict_idle()
+        thread = threading.Thread(target=evict_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        with self._lock:
+            entries = list(self._consumers.values())
+            self._consumers = {}
+        for entry in entries:
+            self._stop(entry)
+
+
+CONSUMERS = ConsumerCache(KAFKA, CONSUMER_TTL)
+
+if SPOOL_MAX_SIZE_MB:
+    SPOOL = Spool(SPOOL_DIR, SPOOL_MAX_SIZE_MB * 1024 * 1024, SPOOL_MAX_AGE_HOURS * 3600)
+else:
+    SPOOL = None
+
+
+def spool(messages):
+    """Spools (topic, value, key) tuples; the ones that don't fit are
+    logged and dropped."""
+    dropped = 0
+    for topic, value, key in messages:
+        try:
+            SPOOL.append(topic, value, None if key is None else bytes(key),
+                         getattr(key, 'partition_id', None))
+        except SpoolFullError:
+            dropped += 1
+    if dropped:
+        logging.error("Dropped %s messages because the spool is full", dropped)
+
+
+class Sender(object):
+    """Thread that delivers the messages of producer-mode 'async' in batches
+    and spools the batches Kafka doesn't acknowledge, like the asyncio
+    server does."""
+    def __init__(self, kafka, batch_size, timeout):
+        self.kafka = kafka
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue = Queue(batch_size * 10)
+        self._thread = None
+
+    def put(self, topic, value, key=None):
+        # Blocks the request while the queue is full.
+        self._queue.put((topic, value, key))
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _send(self, batch):
+        if SPOOL is not None and SPOOL.pending():
+            spool(batch)
+            return
+        try:
+            self.kafka.deliver(batch, self.timeout)
+        except DELIVERY_ERRORS + (Empty, ValueError):
+            if SPOOL is None:
+                logging.exception("Dropped %s messages that Kafka did not acknowledge", len(batch))
+            else:
+                logging.warning("Spooling %s messages that Kafka did not acknowledge", len(batch))
+                spool(batch)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            if batch:
+                try:
+                    self._send(batch)
+                except Exception: # pylint: disable=w0703
+                    # Eg. the disk of the spool is full. Keep the thread
+                    # alive, or put() blocks once the queue is full.
+                    logging.exception("Dropped %s messages that could not be sent or spooled", len(batch))
+            if done:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Sends the queued messages and stops the thread."""
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+
+
+SENDER = Sender(KAFKA, MAX_BATCH_SIZE, DELIVERY_TIMEOUT)
+
+
+def produce(topic, value, key=None, sync=False):
+    """Delivers one message, or spools it when Kafka can't be reached or
+    older messages are still spooled. Async messages are handed to SENDER,
+    which spools them if they fail later. Returns whether it was spooled."""
+    if not sync:
+        SENDER.put(topic, value, key)
+        # SENDER spools it as well while older messages are spooled.
+        return SPOOL is not None and SPOOL.pending()
+    if SPOOL is None or not SPOOL.pending():
+        try:
+            with KAFKA.producer(topic) as producer:
+                producer.produce(value, partition_key=key)
+            return False
+        except DELIVERY_ERRORS:
+            if SPOOL is None:
+                raise
+    SPOOL.append(topic, value, None if key is None else bytes(key),
+                 getattr(key, 'partition_id', None))
+    return True
+
+
+def deliver_spooled(records):
+    messages = []
+    for record in records:
+        key = record.key
+        if record.partition_id is not None:
+            if record.partition_id not in KAFKA.topic(record.topic).partitions:
+                logging.warning("Dropping spooled message for missing partition %s of %s",
+                                record.partition_id, record.topic)
+                continue
+            key = RoutedKey(key or b'', record.partition_id)
+        messages.append((record.topic, record.value, key))
+    KAFKA.deliver(messages, DELIVERY_TIMEOUT)
+
+
+def adopt_orphaned_spools():
+    """Moves the spools of the workers that were removed by lowering
+    `workers` into the spool of this worker, so their messages are replayed.
+    Worker n adopts the spools of workers n + WORKERS, n + 2 * WORKERS..."""
+    root = os.path.dirname(SPOOL_DIR)
+    for name in os.listdir(root):
+        if name.isdigit() and int(name) >= WORKERS and int(name) % WORKERS == WORKER:
+            SPOOL.adopt(os.path.join(root, name))
+
+
+def start_adopting():
+    def adopt_forever():
+        while True:
+            try:
+                adopt_orphaned_spools()
+            except EnvironmentError:
+                logging.exception("Adopting orphaned spools failed")
+            time.sleep(ADOPT_INTERVAL)
+    thread = threading.Thread(target=adopt_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def iter_body_chunks(chunk_size=CHUNK_SIZE):
+    """Yields the request body in chunks of at most `chunk_size` bytes,
+    gunzipped if the client sent `Content-Encoding: gzip`."""
+    if request.headers.get('Content-Encoding', '').lower() in GZIP_ENCODINGS:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = None
+    while True:
+        chunk = request.stream.read(chunk_size)
+        if not chunk:
+            break
+        if not decompressor:
+            yield chunk
+            continue
+        # Limit the output so a small gzip bomb can't fill the memory.
+        while chunk:
+            data = decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+            if data:
+                yield data
+    if decompressor:
+        yield decompressor.flush()
+        # Python 2 can't tell whether the stream was truncated.
+        if not getattr(decompressor, 'eof', True):
+            raise zlib.error("incomplete gzip stream")
+
+
+def request_body(max_size=MAX_BODY_SIZE):
+    """Returns the whole request body, gunzipped if needed. Raises
+    RequestEntityTooLarge when it is larger than `max_size` bytes."""
+    if (request.content_length or 0) > max_size:
+        raise RequestEntityTooLarge()
+    chunks = []
+    size = 0
+    for chunk in iter_body_chunks():
+        size += len(chunk)
+        if size > max_size:
+            raise RequestEntityTooLarge()
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def iter_body_lines(max_size=MAX_BODY_SIZE):
+    """Yields the non-empty lines of the request body. Lines larger than
+    `max_size` bytes are skipped and yielded as None."""
+    pending = b''
+    skipping = False
+    for chunk in iter_body_chunks():
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if skipping:
+                # The end of a line that was too large.
+                skipping = False
+                yield None
+                continue
+            line = line.rstrip(b'\r')
+            if len(line) > max_size:
+                yield None
+            elif line:
+                yield line
+        if len(pending) > max_size:
+            pending = b''
+            skipping = True
+    pending = pending.rstrip(b'\r')
+    if skipping:
+        yield None
+    elif pending:
+        yield pending
+
+
+def message_dict(message):
+    return {
+        'partition': message.partition_id,
+        'offset': message.offset,
+        'value': message.value.decode('UTF-8', 'replace'),
+    }
+
+
+FORMATTERS = {
+    'text': ('text/plain', lambda m: "{}: {}\n".format(m.offset, m.value)),
+    'ndjson': ('application/x-ndjson', lambda m: json.dumps(message_dict(m)) + "\n"),
+}
+
+
+@APP.before_request
+def check_content_encoding():
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding not in ('identity',) + GZIP_ENCODINGS:
+        return Response(
+            "Unsupported Content-Encoding: {}".format(encoding),
+            status=415,
+            mimetype='text/plain',
+        )
+
+
+@APP.errorhandler(zlib.error)
+def invalid_gzip(_):
+    return Response(
+        "Request body is not valid gzip",
+        status=400,
+        mimetype='text/plain',
+    )
+
+
+@APP.errorhandler(RequestEntityTooLarge)
+def body_too_large(_):
+    return Response(
+        "Request body is larger than {} bytes".format(MAX_BODY_SIZE),
+        status=413,
+        mimetype='text/plain',
+    )
+
+
+@APP.errorhandler(SpoolFullError)
+def spool_full(_):
+    return Response(
+        "Kafka is unreachable and the spool is full",
+        status=503,
+        mimetype='text/plain',
+    )
+
+
 @APP.route("/")
 def hello():
     return "REST to kafka v0.0.1"
 
 @APP.route("/<topic>", methods=['GET'])
 def get_topic(topic):
-    client = KafkaClient(hosts=KAFKA_CONNECT)
-    intopic = client.topics[topic.encode('UTF-8')]
-    consumer = intopic.get_simple_consumer(consumer_timeout_ms=1000)
-    text = ''
-    for message in consumer:
-        if message is not None:
-            text = text + "{}: {}\n".format(message.offset, message.value)
+    """Streams the messages of a topic as they are read. Query parameters:
+    `from_offset`, `partition`, `limit` and `format` (text or ndjson)."""
+    try:
+        from_offset = int(request.args.get('from_offset', 0))
+        partition = request.args.get('partition')
+        partition = None if partition is None else int(partition)
+        limit = int(request.args.get('limit', 0))
+    except ValueError:
+        return Response(
+            "from_offset, partition and limit must be integers",
+            status=400,
+            mimetype='text/plain',
+        )
+    output_format = request.args.get('format', 'text')
+    if output_format not in FORMATTERS:
+        return Response(
+            "format must be one of {}".format(', '.join(sorted(FORMATTERS))),
+            status=400,
+            mimetype='text/plain',
+        )
+    intopic = KAFKA.topic(topic)
+    if partition is None:
+        partitions = list(intopic.partitions.values())
+    elif partition in intopic.partitions:
+        partitions = [intopic.partitions[partition]]
+    else:
+        return Response(
+            "Topic has no partition {}".format(partition),
+            status=404,
+            mimetype='text/plain',
+        )
+    consumer = intopic.get_simple_consumer(
+        partitions=partitions,
+        auto_offset_reset=OffsetType.EARLIEST,
+        reset_offset_on_start=True,
+        consumer_timeout_ms=1000)
+    if from_offset > 0:
+        # The consumer continues after the offset it is reset to.
+        consumer.reset_offsets([(p, from_offset - 1) for p in partitions])
+    mimetype, formatter = FORMATTERS[output_format]
+
+    def generate():
+        try:
+            for count, message in enumerate(consumer, 1):
+                yield formatter(message)
+                if count == limit:
+                    break
+        finally:
+            consumer.stop()
     return Response(
-        text,
+        generate(),
         status=200,
-        mimetype='text/plain',
+        mimetype=mimetype,
     )
 
 
+@APP.route("/<topic>/poll", methods=['GET'])
+def poll_topic(topic):
+    """Returns the next messages of `topic` for consumer group `group`.
+    Offsets are committed once the response is sent."""
+    group = request.args.get('group')
+    try:
+        max_messages = min(int(request.args.get('max', 100)), MAX_POLL_MESSAGES)
+        timeout_ms = min(int(request.args.get('timeout_ms', 1000)), MAX_POLL_TIMEOUT_MS)
+    except ValueError:
+        return Response(
+            "max and timeout_ms must be integers",
+            status=400,
+            mimetype='text/plain',
+        )
+    if not group:
+        return Response(
+            "group is required",
+            status=400,
+            mimetype='text/plain',
+        )
+    entry = CONSUMERS.checkout(topic, group)
+    try:
+        response = jsonify(messages=[message_dict(m) for m in entry.poll(max_messages, timeout_ms)])
+    except Exception:
+        CONSUMERS.checkin(entry, failed=True)
+        raise
+    response.call_on_close(lambda: CONSUMERS.checkin(entry))
+    return response
+
+
 @APP.route("/<topic>", methods=['POST'])
 def POST_topic(topic):
-    client = KafkaClient(hosts=KAFKA_CONNECT)
-    topic = client.topics[topic.encode('UTF-8')]
-    with topic.get_sync_producer() as producer:
-        producer.produce(request.data)
+    """Produces the request body as one message. The message key is taken
+    from the `X-Kafka-Key` header or the `key` parameter; `partition`
+    overrides the partition the partitioner picks."""
+    key = request.headers.get('X-Kafka-Key', request.args.get('key'))
+    if key is not None and not isinstance(key, bytes):
+        key = key.encode('UTF-8')
+    partition = request.args.get('partition')
+    if partition is not None:
+        if not partition.isdigit() or not has_partition(topic, int(partition)):
+            return Response(
+                "Topic has no partition {}".format(partition),
+                status=404,
+                mimetype='text/plain',
+            )
+        key = RoutedKey(key or b'', int(partition))
+    sync = PRODUCER_MODE != 'async' or request.args.get('sync', 'false').lower() == 'true'
+    if produce(topic, request_body(), key, sync):
+        return Response(
+            "Kafka is unreachable, data spooled for topic",
+            status=202,
+            mimetype='text/plain',
+        )
+    if not sync:
+        return Response(
+            "Data queued for topic",
+            status=202,
+            mimetype='text/plain',
+        )
     return Response(
         "Data written to topic",
         status=200,
         mimetype='text/plain',
     )
 
+
+def has_partition(topic, partition_id):
+    try:
+        return partition_id in KAFKA.topic(topic).partitions
+    except DELIVERY_ERRORS:
+        # Kafka is down; the partition is checked when the spool is replayed.
+        return SPOOL is not None
+
+
+@APP.route("/<topic>/batch", methods=['POST'])
+def POST_batch(topic):
+    """Produces every line of a newline-delimited JSON body as a separate
+    message. Lines that are not valid JSON, that are larger than
+    MAX_BODY_SIZE or that can't be queued or spooled are counted as
+    failed. When the gzip stream breaks off, the counts so far are returned
+    with a 400 and `truncated` set, since those lines are already queued."""
+    accepted = failed = spooled = 0
+    try:
+        for line in iter_body_lines():
+            if line is None:
+                failed += 1
+                continue
+            try:
+                json.loads(line.decode('UTF-8'))
+                spooled += produce(topic, line)
+            except (ValueError, SpoolFullError) + DELIVERY_ERRORS:
+                failed += 1
+            else:
+                accepted += 1
+    except zlib.error:
+        response = jsonify(accepted=accepted, failed=failed, spooled=spooled, truncated=True)
+        response.status_code = 400
+        return response
+    response = jsonify(accepted=accepted, failed=failed, spooled=spooled)
+    response.status_code = 202
+    return response
+
 if __name__ == "__main__":
     DEBUG = (os.environ.get('DEBUG', 'False').lower() == 'true')
-    APP.run(host='0.0.0.0', debug=DEBUG, threaded=True)
+    # Flush the async producers and leave the consumer groups when upstart
+    # stops the service.
+    atexit.register(KAFKA.reset)
+    atexit.register(CONSUMERS.close)
+    CONSUMERS.start_evicting()
+    if SPOOL:
+        atexit.register(SPOOL.close)
+        SPOOL.start(deliver_spooled)
+        start_adopting()
+    # Registered last so it runs first, while the producers and the spool
+    # are still open.
+    atexit.register(SENDER.close)
+    SENDER.start()
+    logging.basicConfig(level=logging.INFO)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    APP.debug = DEBUG
+    # Other workers listen on the same port, see reuseport.py.
+    SOCKET = listen_socket(PORT)
+    SERVER = make_server('0.0.0.0', PORT, APP, threaded=True, fd=SOCKET.fileno())
+    # Python waits for the running requests before it exits.
+    SERVER.daemon_threads = False
+    try:
+        SERVER.serve_forever()
+    finally:
+        # Stop accepting connections, so the kernel sends them to the other
+        # workers.
+        SERVER.server_close()
+        SOCKET.close()
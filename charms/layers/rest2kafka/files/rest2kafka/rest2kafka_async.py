@@ -0,0 +1,652 @@
+#!/usr/bin/python3
+#pylint: disable=c0111,c0103
+# asyncio version of rest2kafka.py with the same routes and settings. One
+# event loop serves all connections, so thousands of mostly idle keep-alive
+# clients don't need a thread each. Coroutines use `yield from` to run on the
+# Python 3.4 of trusty; aiohttp 3 and aiokafka 0.3 need Python 3.5.
+# Full docs aiohttp: https://aiohttp.readthedocs.io/
+# Full docs aiokafka: https://aiokafka.readthedocs.io/
+# Installation
+# sudo apt-get install python3-pip
+# sudo pip3 install 'aiohttp>=2.3.10,<3.0' 'aiokafka>=0.2.3,<0.3'
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import time
+import zlib
+
+from aiohttp import web, web_protocol
+from aiohttp.http_parser import HttpRequestParserPy
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
+try:
+    from aiokafka.errors import KafkaError
+    from aiokafka.structs import TopicPartition
+except ImportError:
+    from kafka.common import KafkaError, TopicPartition
+
+from reuseport import listen_socket
+from spool import Spool, SpoolFullError
+
+KAFKA_CONNECT_PATH = os.path.realpath(os.path.dirname(__file__) + '/etc/kafka.connect')
+PRODUCER_MODE = os.environ.get('PRODUCER_MODE', 'sync')
+REQUIRED_ACKS = int(os.environ.get('REQUIRED_ACKS', 1))
+COMPRESSION = os.environ.get('COMPRESSION', 'none')
+PRODUCER_OPTIONS = {
+    'linger_ms': int(os.environ.get('LINGER_MS', 100)),
+    'acks': 'all' if REQUIRED_ACKS < 0 else REQUIRED_ACKS,
+    'compression_type': None if COMPRESSION == 'none' else COMPRESSION,
+}
+PARTITIONER = os.environ.get('PARTITIONER', 'hashing')
+CONSUMER_TTL = int(os.environ.get('CONSUMER_TTL', 300))
+MAX_POLL_MESSAGES = 10000
+MAX_POLL_TIMEOUT_MS = 30000
+CHUNK_SIZE = 64 * 1024
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+# Maximum size of a message after gunzipping: the body of POST /{topic} or
+# a line of POST /{topic}/batch.
+MAX_BODY_SIZE = int(os.environ.get('MAX_BODY_SIZE_MB', 16)) * 1024 * 1024
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+WORKER = int(os.environ.get('WORKER', 0))
+WORKERS = int(os.environ.get('WORKERS', 1))
+# Every worker process has a spool of its own.
+SPOOL_DIR = os.environ.get('SPOOL_DIR', os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), 'spool', str(WORKER)))
+# Seconds between looking for the spools of removed workers.
+ADOPT_INTERVAL = 10
+SPOOL_MAX_SIZE_MB = int(os.environ.get('SPOOL_MAX_SIZE_MB', 1024))
+SPOOL_MAX_AGE_HOURS = int(os.environ.get('SPOOL_MAX_AGE_HOURS', 24))
+DELIVERY_ERRORS = (KafkaError, OSError)
+PORT = int(os.environ.get('PORT', 5000))
+KEEPALIVE_TIMEOUT = 75
+
+LOG = logging.getLogger('rest2kafka')
+
+
+def random_partitioner(key, all_partitions, available):
+    return random.choice(available or all_partitions)
+
+
+if PARTITIONER == 'random':
+    PRODUCER_OPTIONS['partitioner'] = random_partitioner
+elif PARTITIONER != 'hashing':
+    # Custom partitioners are written for pykafka's interface.
+    LOG.warning("Partitioner %s is not supported in asyncio mode, using 'hashing'", PARTITIONER)
+
+
+class RequestHandler(web_protocol.RequestHandler):
+    """Leaves gzip request bodies compressed so `BodyReader` can gunzip
+    them with a limit; aiohttp gunzips every network chunk in full. Only
+    the pure Python parser of aiohttp 2.3 can turn that off."""
+    def __init__(self, manager, **kwargs):
+        super().__init__(manager, **kwargs)
+        self._request_parser = HttpRequestParserPy(
+            self, self._loop,
+            payload_exception=web_protocol.RequestPayloadError,
+            auto_decompress=False)
+
+
+class BodyReader(object):
+    """Reads a request body in chunks of at most CHUNK_SIZE bytes,
+    gunzipped if the client sent `Content-Encoding: gzip`."""
+    def __init__(self, request):
+        self.content = request.content
+        self.decompressor = None
+        if request.headers.get('Content-Encoding', '').lower() in GZIP_ENCODINGS:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._tail = b''
+        self._done = False
+
+    @asyncio.coroutine
+    def read(self):
+        """Returns the next chunk, or b'' at the end of the body."""
+        if self.decompressor is None:
+            return (yield from self.content.read(CHUNK_SIZE))
+        while True:
+            if self._tail:
+                # Limit the output so a small gzip bomb can't fill the memory.
+                data = self.decompressor.decompress(self._tail, CHUNK_SIZE)
+                self._tail = self.decompressor.unconsumed_tail
+                if data:
+                    return data
+                continue
+            if self._done:
+                return b''
+            self._tail = yield from self.content.read(CHUNK_SIZE)
+            if not self._tail:
+                self._done = True
+                if not self.decompressor.eof:
+                    raise zlib.error("incomplete gzip stream")
+                return self.decompressor.flush()
+
+
+def read_hosts(connect_path):
+    with open(connect_path, "r") as connect_file:
+        return connect_file.read().strip()
+
+
+class Kafka(object):
+    """The aiokafka producer of the process. It is started on first use and
+    again when the brokers in `connect_path` change."""
+    check_interval = 1
+
+    def __init__(self, loop, connect_path, producer_options):
+        self.loop = loop
+        self.connect_path = connect_path
+        self.producer_options = producer_options
+        self.hosts = None
+        self._producer = None
+        self._checked = 0
+        self._lock = asyncio.Lock()
+
+    @asyncio.coroutine
+    def producer(self):
+        if self._producer and time.time() - self._checked < self.check_interval:
+            return self._producer
+        yield from self._lock.acquire()
+        try:
+            self._checked = time.time()
+            hosts = read_hosts(self.connect_path)
+            if self._producer and hosts == self.hosts:
+                return self._producer
+            yield from self.close()
+            producer = AIOKafkaProducer(
+                loop=self.loop, bootstrap_servers=hosts, **self.producer_options)
+            yield from producer.start()
+            self._producer, self.hosts = producer, hosts
+            return producer
+        finally:
+            self._lock.release()
+
+    @asyncio.coroutine
+    def close(self):
+        """Stops the producer after it delivered the queued messages."""
+        producer, self._producer = self._producer, None
+        if producer:
+            yield from producer.stop()
+
+
+class GroupConsumer(object):
+    """A consumer of one topic for one consumer group. `lock` is held from
+    the start of a poll until its offsets are committed."""
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+
+
+class ConsumerCache(object):
+    """Keeps one `GroupConsumer` per topic and consumer group. Consumers
+    that are not polled for `ttl` seconds are stopped by `evict_idle()` so
+    their partitions go to the other members of the group."""
+    def __init__(self, loop, connect_path, ttl):
+        self.loop = loop
+        self.connect_path = connect_path
+        self.ttl = ttl
+        self._consumers = {}
+        self._lock = asyncio.Lock()
+
+    @asyncio.coroutine
+    def checkout(self, topic, group):
+        """Returns the locked consumer of `topic` for `group`. Hand it back
+        with `checkin()`."""
+        yield from self._lock.acquire()
+        try:
+            entry = self._consumers.get((topic, group))
+            if entry is None:
+                consumer = AIOKafkaConsumer(
+                    topic,
+                    loop=self.loop,
+                    bootstrap_servers=read_hosts(self.connect_path),
+                    group_id=group,
+                    enable_auto_commit=False,
+                    auto_offset_reset='earliest')
+                yield from consumer.start()
+                entry = self._consumers[(topic, group)] = GroupConsumer(consumer)
+            entry.last_used = time.time()
+        finally:
+            self._lock.release()
+        yield from entry.lock.acquire()
+        return entry
+
+    @asyncio.coroutine
+    def checkin(self, entry, failed=False):
+        """Commits the offsets of the polled messages. When delivering them
+        failed, the consumer is stopped instead so the group resumes from
+        the last committed offsets."""
+        try:
+            if not failed:
+                yield from entry.consumer.commit()
+                return
+            for key, value in list(self._consumers.items()):
+                if value is entry:
+                    del self._consumers[key]
+            yield from entry.consumer.stop()
+        finally:
+            entry.lock.release()
+
+    @asyncio.coroutine
+    def _stop(self, entry):
+        yield from entry.lock.acquire()
+        try:
+            yield from entry.consumer.stop()
+        finally:
+            entry.lock.release()
+
+    @asyncio.coroutine
+    def evict_idle(self):
+        deadline = time.time() - self.ttl
+        evicted = [(key, entry) for key, entry in self._consumers.items()
+                   if entry.last_used < deadline]
+        for key, entry in evicted:
+            del self._consumers[key]
+            yield from self._stop(entry)
+        return len(evicted)
+
+    @asyncio.coroutine
+    def evict_forever(self):
+        while True:
+            yield from asyncio.sleep(max(1, self.ttl / 2))
+            yield from self.evict_idle()
+
+    @asyncio.coroutine
+    def close(self):
+        entries, self._consumers = list(self._consumers.values()), {}
+        for entry in entries:
+            yield from self._stop(entry)
+
+
+def text_response(text, status=200):
+    return web.Response(text=text, status=status, content_type='text/plain')
+
+
+def json_response(content, status=200):
+    return web.Response(text=json.dumps(content), status=status, content_type='application/json')
+
+
+@asyncio.coroutine
+def write(response, data):
+    response.write(data)
+    yield from response.drain()
+
+
+@asyncio.coroutine
+def spool_append(app, topic, value, key=None, partition=None):
+    """Appends to the spool in a thread, so disk I/O doesn't block the
+    event loop."""
+    yield from app.loop.run_in_executor(
+        None, app['spool'].append, topic, value, key, partition)
+
+
+@asyncio.coroutine
+def spool_failed(app, topic, value, key, partition):
+    try:
+        yield from spool_append(app, topic, value, key, partition)
+    except SpoolFullError:
+        LOG.error("Dropped a message for %s because the spool is full", topic)
+
+
+@asyncio.coroutine
+def produce(app, topic, value, key=None, partition=None, sync=False):
+    """Delivers one message, or spools it when Kafka can't be reached or
+    older messages are still spooled. Returns whether it was spooled."""
+    spool = app['spool']
+    if spool is None or not spool.pending():
+        try:
+            producer = yield from app['kafka'].producer()
+            future = yield from producer.send(topic, value, key=key, partition=partition)
+            if sync:
+                yield from future
+            elif spool is not None:
+                future.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() is None or app.loop.create_task(
+                        spool_failed(app, topic, value, key, partition)))
+            return False
+        except DELIVERY_ERRORS:
+            if spool is None:
+                raise
+    yield from spool_append(app, topic, value, key, partition)
+    return True
+
+
+@asyncio.coroutine
+def drain_spool(app, retry_interval=1, max_retry_interval=30):
+    """Replays the spool in order and in batches, like `Spool.drain()` but
+    through the producer of the event loop. The spool is read in threads."""
+    spool = app['spool']
+    run = app.loop.run_in_executor
+    interval = retry_interval
+    while True:
+        yield from asyncio.sleep(interval)
+        try:
+            yield from run(None, spool.expire)
+            yield from run(None, spool.roll)
+            for segment in spool.segments():
+                while True:
+                    batch = yield from run(
+                        None, spool.read_batch, segment, segment.delivered, MAX_BATCH_SIZE)
+                    if not batch:
+                        break
+                    producer = yield from app['kafka'].producer()
+                    futures = []
+                    for _, record in batch:
+                        if record.partition_id is not None and record.partition_id not in (
+                                yield from producer.partitions_for(record.topic)):
+                            LOG.warning("Dropping spooled message for missing partition %s of %s",
+                                        record.partition_id, record.topic)
+                            continue
+                        futures.append((yield from producer.send(
+                            record.topic, record.value, key=record.key,
+                            partition=record.partition_id)))
+                    # Waits until Kafka acknowledged the whole batch.
+                    yield from asyncio.gather(*futures, loop=app.loop)
+                    segment.delivered = batch[-1][0]
+                yield from run(None, spool.remove, segment)
+            interval = retry_interval
+        except asyncio.CancelledError:
+            raise
+        except Exception: # pylint: disable=w0703
+            LOG.exception("Replaying the spool failed, retrying in %s seconds", interval)
+            interval = min(interval * 2, max_retry_interval)
+
+
+def adopt_orphaned_spools(spool):
+    """Moves the spools of the workers that were removed by lowering
+    `workers` into `spool`, like rest2kafka.py does."""
+    root = os.path.dirname(SPOOL_DIR)
+    for name in os.listdir(root):
+        if name.isdigit() and int(name) >= WORKERS and int(name) % WORKERS == WORKER:
+            spool.adopt(os.path.join(root, name))
+
+
+@asyncio.coroutine
+def adopt_forever(app):
+    while True:
+        try:
+            yield from app.loop.run_in_executor(None, adopt_orphaned_spools, app['spool'])
+        except OSError:
+            LOG.exception("Adopting orphaned spools failed")
+        yield from asyncio.sleep(ADOPT_INTERVAL)
+
+
+@asyncio.coroutine
+def errors_middleware(app, handler): # pylint: disable=w0613
+    @asyncio.coroutine
+    def middleware(request):
+        encoding = request.headers.get('Content-Encoding', 'identity').lower()
+        if encoding not in ('identity',) + GZIP_ENCODINGS:
+            return text_response("Unsupported Content-Encoding: {}".format(encoding), 415)
+        try:
+            return (yield from handler(request))
+        except SpoolFullError:
+            return text_response("Kafka is unreachable and the spool is full", 503)
+        except zlib.error:
+            return text_response("Request body is not valid gzip", 400)
+    return middleware
+
+
+@asyncio.coroutine
+def hello(request): # pylint: disable=w0613
+    return text_response("REST to kafka v0.0.1")
+
+
+def message_dict(message):
+    return {
+        'partition': message.partition,
+        'offset': message.offset,
+        'value': message.value.decode('UTF-8', 'replace'),
+    }
+
+
+FORMATTERS = {
+    'text': ('text/plain', lambda m: "{}: {}\n".format(m.offset, m.value.decode('UTF-8', 'replace'))),
+    'ndjson': ('application/x-ndjson', lambda m: json.dumps(message_dict(m)) + "\n"),
+}
+
+
+@asyncio.coroutine
+def get_topic(request):
+    """Streams the messages of a topic as they are read. Query parameters:
+    `from_offset`, `partition`, `limit` and `format` (text or ndjson)."""
+    topic = request.match_info['topic']
+    try:
+        from_offset = int(request.query.get('from_offset', 0))
+        partition = request.query.get('partition')
+        partition = None if partition is None else int(partition)
+        limit = int(request.query.get('limit', 0))
+    except ValueError:
+        return text_response("from_offset, partition and limit must be integers", 400)
+    output_format = request.query.get('format', 'text')
+    if output_format not in FORMATTERS:
+        return text_response("format must be one of {}".format(', '.join(sorted(FORMATTERS))), 400)
+    consumer = AIOKafkaConsumer(
+        loop=request.app.loop,
+        bootstrap_servers=read_hosts(KAFKA_CONNECT_PATH),
+        enable_auto_commit=False,
+        # Offsets before the first retained message start at the beginning.
+        auto_offset_reset='earliest')
+    yield from consumer.start()
+    try:
+        yield from consumer.topics()
+        available = consumer.partitions_for_topic(topic) or set()
+        if partition is not None and partition not in available:
+            return text_response("Topic has no partition {}".format(partition), 404)
+        partitions = [TopicPartition(topic, p) for p in sorted(available)
+                      if partition is None or p == partition]
+        consumer.assign(partitions)
+        for topic_partition in partitions:
+            consumer.seek(topic_partition, max(from_offset, 0))
+        mimetype, formatter = FORMATTERS[output_format]
+        response = web.StreamResponse()
+        response.content_type = mimetype
+        yield from response.prepare(request)
+        count = 0
+        while partitions and (not limit or count < limit):
+            # Stop, like the Flask app, after a second without messages.
+            batches = yield from consumer.getmany(timeout_ms=1000)
+            if not batches:
+                break
+            for messages in batches.values():
+                for message in messages[:limit - count if limit else None]:
+                    yield from write(response, formatter(message).encode('UTF-8'))
+                    count += 1
+        yield from response.write_eof()
+        return response
+    finally:
+        yield from consumer.stop()
+
+
+@asyncio.coroutine
+def poll_topic(request):
+    """Returns the next messages of `topic` for consumer group `group`.
+    Offsets are committed once the response is sent."""
+    topic = request.match_info['topic']
+    group = request.query.get('group')
+    try:
+        max_messages = min(int(request.query.get('max', 100)), MAX_POLL_MESSAGES)
+        timeout_ms = min(int(request.query.get('timeout_ms', 1000)), MAX_POLL_TIMEOUT_MS)
+    except ValueError:
+        return text_response("max and timeout_ms must be integers", 400)
+    if not group:
+        return text_response("group is required", 400)
+    consumers = request.app['consumers']
+    entry = yield from consumers.checkout(topic, group)
+    try:
+        batches = yield from entry.consumer.getmany(timeout_ms=timeout_ms)
+        messages = []
+        for topic_partition, partition_messages in batches.items():
+            returned = partition_messages[:max_messages - len(messages)]
+            messages.extend(message_dict(m) for m in returned)
+            if len(returned) < len(partition_messages):
+                # Fetch the rest again on the next poll.
+                entry.consumer.seek(topic_partition, partition_messages[len(returned)].offset)
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        yield from response.prepare(request)
+        yield from write(response, json.dumps({'messages': messages}).encode('UTF-8'))
+        yield from response.write_eof()
+    except Exception:
+        yield from consumers.checkin(entry, failed=True)
+        raise
+    yield from consumers.checkin(entry)
+    return response
+
+
+def parse_key(request):
+    key = request.headers.get('X-Kafka-Key', request.query.get('key'))
+    return None if key is None else key.encode('UTF-8')
+
+
+@asyncio.coroutine
+def has_partition(app, topic, partition_id):
+    try:
+        producer = yield from app['kafka'].producer()
+        return partition_id in (yield from producer.partitions_for(topic))
+    except DELIVERY_ERRORS:
+        # Kafka is down; the partition is checked when the spool is replayed.
+        return app['spool'] is not None
+
+
+def body_too_large():
+    return text_response("Request body is larger than {} bytes".format(MAX_BODY_SIZE), 413)
+
+
+@asyncio.coroutine
+def post_topic(request):
+    """Produces the request body as one message. The message key is taken
+    from the `X-Kafka-Key` header or the `key` parameter; `partition`
+    overrides the partition the partitioner picks."""
+    topic = request.match_info['topic']
+    key = parse_key(request)
+    partition = request.query.get('partition')
+    if partition is not None:
+        if not partition.isdigit() or not (yield from has_partition(request.app, topic, int(partition))):
+            return text_response("Topic has no partition {}".format(partition), 404)
+        partition = int(partition)
+    sync = PRODUCER_MODE != 'async' or request.query.get('sync', 'false').lower() == 'true'
+    if (request.content_length or 0) > MAX_BODY_SIZE:
+        return body_too_large()
+    reader = BodyReader(request)
+    chunks = []
+    size = 0
+    while True:
+        chunk = yield from reader.read()
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            return body_too_large()
+        chunks.append(chunk)
+    body = b''.join(chunks)
+    if (yield from produce(request.app, topic, body, key, partition, sync)):
+        return text_response("Kafka is unreachable, data spooled for topic", 202)
+    if not sync:
+        return text_response("Data queued for topic", 202)
+    return text_response("Data written to topic")
+
+
+@asyncio.coroutine
+def post_batch(request):
+    """Produces every line of a newline-delimited JSON body as a separate
+    message. Lines that are not valid JSON, that are larger than
+    MAX_BODY_SIZE or that can't be queued or spooled are counted as
+    failed. When the gzip stream breaks off, the counts so far are returned
+    with a 400 and `truncated` set, like rest2kafka.py does."""
+    topic = request.match_info['topic']
+    accepted = failed = spooled = 0
+    reader = BodyReader(request)
+    pending = b''
+    skipping = False
+    try:
+        while True:
+            chunk = yield from reader.read()
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop() if chunk else b''
+            for line in lines:
+                if skipping:
+                    # The end of a line that was too large.
+                    skipping = False
+                    failed += 1
+                    continue
+                line = line.rstrip(b'\r')
+                if len(line) > MAX_BODY_SIZE:
+                    failed += 1
+                    continue
+                if not line:
+                    continue
+                try:
+                    json.loads(line.decode('UTF-8'))
+                    spooled += yield from produce(request.app, topic, line)
+                except (ValueError, SpoolFullError) + DELIVERY_ERRORS:
+                    failed += 1
+                else:
+                    accepted += 1
+            if len(pending) > MAX_BODY_SIZE:
+                pending = b''
+                skipping = True
+            if not chunk:
+                break
+    except zlib.error:
+        return json_response({'accepted': accepted, 'failed': failed, 'spooled': spooled,
+                              'truncated': True}, 400)
+    return json_response({'accepted': accepted, 'failed': failed, 'spooled': spooled}, 202)
+
+
+@asyncio.coroutine
+def on_shutdown(app):
+    # Flush the producer and leave the consumer groups.
+    for task in app['tasks']:
+        task.cancel()
+    yield from app['consumers'].close()
+    yield from app['kafka'].close()
+    if app['spool']:
+        app['spool'].close()
+
+
+def make_app(loop):
+    app = web.Application(loop=loop, middlewares=[errors_middleware])
+    app['kafka'] = Kafka(loop, KAFKA_CONNECT_PATH, PRODUCER_OPTIONS)
+    app['consumers'] = ConsumerCache(loop, KAFKA_CONNECT_PATH, CONSUMER_TTL)
+    app['tasks'] = [loop.create_task(app['consumers'].evict_forever())]
+    app['spool'] = None
+    if SPOOL_MAX_SIZE_MB:
+        app['spool'] = Spool(SPOOL_DIR, SPOOL_MAX_SIZE_MB * 1024 * 1024, SPOOL_MAX_AGE_HOURS * 3600)
+        app['spool'].start()
+        app['tasks'].append(loop.create_task(drain_spool(app)))
+        app['tasks'].append(loop.create_task(adopt_forever(app)))
+    app.on_shutdown.append(on_shutdown)
+    app.router.add_route('GET', '/', hello)
+    app.router.add_route('GET', '/{topic}', get_topic)
+    app.router.add_route('POST', '/{topic}', post_topic)
+    app.router.add_route('GET', '/{topic}/poll', poll_topic)
+    app.router.add_route('POST', '/{topic}/batch', post_batch)
+    return app
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    app = make_app(loop)
+    handler = app.make_handler(keepalive_timeout=KEEPALIVE_TIMEOUT)
+    # Other workers listen on the same port, see reuseport.py.
+    server = loop.run_until_complete(loop.create_server(
+        lambda: RequestHandler(handler, loop=loop, keepalive_timeout=KEEPALIVE_TIMEOUT),
+        sock=listen_socket(PORT)))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(handler.shutdown(30))
+        loop.run_until_complete(app.cleanup())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
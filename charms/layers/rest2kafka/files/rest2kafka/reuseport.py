@@ -0,0 +1,16 @@
+#pylint: disable=c0111,c0103
+import socket
+
+# Missing from the socket module of Python 2.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def listen_socket(port, host='0.0.0.0', backlog=1024):
+    """Returns a listening socket with SO_REUSEPORT set, so every worker can
+    bind to the same port and the kernel spreads connections over them."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
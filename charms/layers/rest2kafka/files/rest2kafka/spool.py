@@ -0,0 +1,252 @@
+#pylint: disable=c0111,c0103
+"""Append-only spool on local disk for messages that can't be delivered to
+Kafka yet.
+
+Messages are appended to segment files of at most `segment_size` bytes.
+Appends are buffered and fsynced in batches every `fsync_interval` seconds,
+so a crash loses at most that much. Closed segments are replayed in order by
+memory-mapping them and removed once every record in them is delivered.
+A process holds a lock on its spool directory; `adopt()` takes over the
+segments of a directory whose process is gone.
+
+Every record is a header (crc32, topic length, partition id, key length,
+value length) followed by the topic, key and value. A partition id or key
+length of -1 means none. Replay stops at the first torn or corrupt record of
+a segment.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from itertools import islice
+
+HEADER = struct.Struct('>IHiiI')
+LOG = logging.getLogger(__name__)
+
+Record = namedtuple('Record', ['topic', 'partition_id', 'key', 'value'])
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.created = os.path.getmtime(path) if os.path.exists(path) else time.time()
+        # Offset up to which the records are delivered.
+        self.delivered = 0
+
+
+def encode(record):
+    topic = record.topic.encode('UTF-8')
+    key = b'' if record.key is None else record.key
+    partition_id = -1 if record.partition_id is None else record.partition_id
+    key_length = -1 if record.key is None else len(key)
+    body = struct.pack('>HiiI', len(topic), partition_id, key_length, len(record.value))
+    body += topic + key + record.value
+    return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+
+class Spool(object):
+    def __init__(self, directory, max_bytes, max_age, segment_size=16 * 1024 * 1024,
+                 fsync_interval=0.1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Waits until a previous process or an adopting one let go.
+        self._lock_file = open(os.path.join(directory, 'lock'), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        names = sorted(n for n in os.listdir(directory) if n.endswith('.seg'))
+        self._segments = [Segment(os.path.join(directory, n)) for n in names]
+        self._next_number = int(names[-1][:-4]) + 1 if names else 0
+        self._active = None
+        self._file = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        segments = self._segments + ([self._active] if self._active else [])
+        return sum(s.size for s in segments)
+
+    def pending(self):
+        """Whether the spool holds records that are not delivered yet. Does
+        not take the lock, so it never waits for an fsync."""
+        active = self._active
+        return bool(self._segments) or bool(active and active.size)
+
+    def append(self, topic, value, key=None, partition_id=None):
+        data = encode(Record(topic, partition_id, key, value))
+        with self._lock:
+            if self.size + len(data) > self.max_bytes:
+                raise SpoolFullError("Spool is full ({} bytes)".format(self.max_bytes))
+            if self._active and self._active.size + len(data) > self.segment_size:
+                self._close_active()
+            if self._active is None:
+                self._active = Segment(os.path.join(
+                    self.directory, '{:020d}.seg'.format(self._next_number)))
+                self._next_number += 1
+                self._file = open(self._active.path, 'ab')
+            self._file.write(data)
+            self._active.size += len(data)
+            self._dirty = True
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def _close_active(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._segments.append(self._active)
+        self._active = self._file = None
+        self._dirty = False
+
+    def roll(self):
+        """Closes the active segment so it can be replayed."""
+        with self._lock:
+            if self._active and self._active.size:
+                self._close_active()
+
+    def segments(self):
+        """Returns the closed segments, oldest first."""
+        with self._lock:
+            return list(self._segments)
+
+    def remove(self, segment):
+        with self._lock:
+            self._segments.remove(segment)
+        os.remove(segment.path)
+
+    def adopt(self, directory):
+        """Moves the segments of the spool in `directory` to the end of
+        this spool, unless a process still holds that spool. Returns the
+        number of adopted segments."""
+        lock_path = os.path.join(directory, 'lock')
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except EnvironmentError:
+                return 0
+            names = sorted(n for n in os.listdir(directory) if n.endswith('.seg'))
+            with self._lock:
+                for name in names:
+                    path = os.path.join(self.directory, '{:020d}.seg'.format(self._next_number))
+                    self._next_number += 1
+                    # Keeps the mtime, so the segment expires as before.
+                    os.rename(os.path.join(directory, name), path)
+                    self._segments.append(Segment(path))
+            os.remove(lock_path)
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+        if names:
+            LOG.info("Adopted %s spool segments of %s", len(names), directory)
+        return len(names)
+
+    def expire(self):
+        """Removes closed segments older than `max_age` seconds and returns
+        how many records were dropped."""
+        deadline = time.time() - self.max_age
+        dropped = 0
+        with self._lock:
+            expired = [s for s in self._segments if s.created < deadline]
+        for segment in expired:
+            dropped += sum(1 for _ in self.read(segment, segment.delivered))
+            self.remove(segment)
+        if dropped:
+            LOG.warning("Dropped %s spooled messages older than %s seconds", dropped, self.max_age)
+        return dropped
+
+    @staticmethod
+    def read(segment, start=0):
+        """Yields the end offset and the record of every record in `segment`
+        from offset `start` on."""
+        if segment.size <= start:
+            return
+        with open(segment.path, 'rb') as s_file:
+            data = mmap.mmap(s_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos + HEADER.size <= len(data):
+                crc, topic_length, partition_id, key_length, value_length = HEADER.unpack_from(data, pos)
+                topic_start = pos + HEADER.size
+                key_start = topic_start + topic_length
+                value_start = key_start + max(key_length, 0)
+                end = value_start + value_length
+                if end > len(data) or zlib.crc32(data[pos + 4:end]) & 0xffffffff != crc:
+                    LOG.warning("Skipping corrupt tail of %s at offset %s", segment.path, pos)
+                    return
+                yield end, Record(
+                    data[topic_start:key_start].decode('UTF-8'),
+                    None if partition_id < 0 else partition_id,
+                    None if key_length < 0 else data[key_start:value_start],
+                    data[value_start:end])
+                pos = end
+        finally:
+            data.close()
+
+    def read_batch(self, segment, start=0, max_records=1000):
+        """Returns the (end offset, record) pairs of at most `max_records`
+        records of `segment` from offset `start` on."""
+        return list(islice(self.read(segment, start), max_records))
+
+    def drain(self, deliver, batch_size=1000):
+        """Replays the spooled records in order through `deliver(records)`,
+        at most `batch_size` at a time, and removes the segments that are
+        fully delivered. Exceptions of `deliver` stop the replay; it resumes
+        at the same batch the next time."""
+        self.expire()
+        self.roll()
+        for segment in self.segments():
+            while True:
+                batch = self.read_batch(segment, segment.delivered, batch_size)
+                if not batch:
+                    break
+                deliver([record for _, record in batch])
+                segment.delivered = batch[-1][0]
+            self.remove(segment)
+
+    def start(self, deliver=None, retry_interval=1, max_retry_interval=30):
+        """Starts the threads that fsync the spool and, if `deliver` is
+        given, drain it in batches through `deliver(records)`."""
+        def sync_forever():
+            while True:
+                time.sleep(self.fsync_interval)
+                self.sync()
+
+        def drain_forever():
+            interval = retry_interval
+            while True:
+                time.sleep(interval)
+                try:
+                    self.drain(deliver)
+                    interval = retry_interval
+                except Exception: # pylint: disable=w0703
+                    LOG.exception("Replaying the spool failed, retrying in %s seconds", interval)
+                    interval = min(interval * 2, max_retry_interval)
+        for target in (sync_forever, drain_forever) if deliver else (sync_forever,):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        with self._lock:
+            if self._active:
+                self._close_active()
@@ -15,16 +15,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import pwd
 import grp
+import multiprocessing
 import os
+import re
 import shutil
 import subprocess
+import time
 
 from charms.reactive import when, when_not, hook
-from charms.reactive import set_state, remove_state
+from charms.reactive import set_state, remove_state, is_state
 from charmhelpers.core import hookenv, host, templating
 from charmhelpers.core.hookenv import open_port, close_port, charm_dir
 from charms import apt #(dependency will be added by apt layer) pylint: disable=E0401,E0611
 
+SERVER_COMMANDS = {
+    'flask': '/opt/rest2kafka/rest2kafka.py',
+    'asyncio': '/opt/rest2kafka/rest2kafka_async.py',
+}
+WORKER_JOB = 'rest2kafka-worker'
+# Seconds a worker gets to start listening before the next one restarts.
+WORKER_START_DELAY = 3
+
 # Fix for issue where $HOME is not /root while running debug-hooks or dhx
 os.environ['HOME'] = "/root"
 
@@ -55,32 +66,100 @@ def configure_rest2kafka(kafka):
 def remove_kafka_configured():
     remove_state('kafka.configured')
 
+@when('rest2kafka.installed', 'config.changed')
+def config_changed():
+    install_server_packages()
+    render_upstart_template()
+    if is_state('kafka.configured'):
+        restart_rest2kafka()
+
 def install_rest2kafka():
     apt.add_source('ppa:cwchien/gradle')
-    apt.queue_install(['python-pip', 'python-dev'])
+    apt.queue_install(['python-pip', 'python-dev', 'python3-pip'])
     apt.update()
     apt.install_queued()
     subprocess.check_call(['pip2', 'install', 'pykafka', 'flask'])
+    install_server_packages()
     # Make hostname resolvable
     service_name = hookenv.local_unit().split('/')[0]
     with open('/etc/hosts', 'a') as hosts_file:
         hosts_file.write('127.0.0.1 {}\n'.format(service_name))
     mergecopytree(charm_dir() + '/files/rest2kafka', "/opt/rest2kafka")
     chownr('/opt/rest2kafka', 'ubuntu', 'ubuntu')
+    render_upstart_template()
+
+
+def install_server_packages():
+    """Installs the Python 3 packages of the asyncio server and the
+    compression codec libraries of the selected server."""
+    conf = hookenv.config()
+    if conf['server'] == 'asyncio':
+        pip = 'pip3'
+        # The last releases that run on the Python 3.4 of trusty and take
+        # the `loop` arguments rest2kafka_async.py passes.
+        packages = ['aiohttp>=2.3.10,<3.0', 'aiokafka>=0.2.3,<0.3']
+    else:
+        pip = 'pip2'
+        packages = []
+    # gzip is part of the standard library.
+    if conf['compression'] == 'snappy':
+        apt.queue_install(['libsnappy-dev'])
+        apt.install_queued()
+        packages.append('python-snappy')
+    elif conf['compression'] == 'lz4':
+        packages.append('lz4')
+    if packages:
+        subprocess.check_call([pip, 'install'] + packages)
+
+
+def render_upstart_template():
+    conf = hookenv.config()
     templating.render(
         source='upstart.conf',
         target='/etc/init/rest2kafka.conf',
         owner='ubuntu',
         group='ubuntu',
+        context={
+            'description': 'rest2kafka',
+            'port': 5000,
+            'workers': worker_count(),
+            'worker_job': WORKER_JOB,
+        }
+    )
+    templating.render(
+        source='upstart-worker.conf',
+        target='/etc/init/{}.conf'.format(WORKER_JOB),
+        owner='ubuntu',
+        group='ubuntu',
         context={
             'user': 'ubuntu',
             'description': 'rest2kafka',
-            'command': '/opt/rest2kafka/rest2kafka.py',
+            'command': SERVER_COMMANDS[conf['server']],
             'debug': 'False',
+            'port': 5000,
+            'environment': {
+                'PRODUCER_MODE': conf['producer-mode'],
+                'PRODUCER_POOL_SIZE': conf['producer-pool-size'],
+                'LINGER_MS': conf['linger-ms'],
+                'MAX_BATCH_SIZE': conf['max-batch-size'],
+                'REQUIRED_ACKS': conf['required-acks'],
+                'CONSUMER_TTL': conf['consumer-ttl'],
+                'PARTITIONER': conf['partitioner'],
+                'COMPRESSION': conf['compression'],
+                'SPOOL_MAX_SIZE_MB': conf['spool-max-size'],
+                'SPOOL_MAX_AGE_HOURS': conf['spool-max-age'],
+                'MAX_BODY_SIZE_MB': conf['max-body-size'],
+                # Workers adopt the spools of the workers that were removed.
+                'WORKERS': worker_count(),
+            },
         }
     )
 
 
+def worker_count():
+    return hookenv.config()['workers'] or multiprocessing.cpu_count()
+
+
 def configure_rest2kafka_kafka(kafka):
     templating.render(
         source='kafka.connect',
@@ -110,8 +189,25 @@ def stop_rest2kafka():
     remove_state('rest2kafka.started')
 
 def restart_rest2kafka():
-    stop_rest2kafka()
-    start_rest2kafka()
+    """Restarts the workers one by one. The other workers keep serving the
+    port while one finishes its in-flight requests and starts again."""
+    if not host.service_running('rest2kafka'):
+        start_rest2kafka()
+        return
+    workers = worker_count()
+    for worker in range(workers):
+        subprocess.call(['stop', WORKER_JOB, 'WORKER={}'.format(worker)])
+        subprocess.check_call(['start', WORKER_JOB, 'WORKER={}'.format(worker)])
+        time.sleep(WORKER_START_DELAY)
+    for worker in running_workers():
+        if worker >= workers:
+            subprocess.call(['stop', WORKER_JOB, 'WORKER={}'.format(worker)])
+
+
+def running_workers():
+    output = subprocess.check_output(['initctl', 'list']).decode('utf-8')
+    return [int(worker) for worker in re.findall(
+        r'^{} \((\d+)\) start/running'.format(WORKER_JOB), output, re.MULTILINE)]
 
 
 def mergecopytree(src, dst, symlinks=False, ignore=None):
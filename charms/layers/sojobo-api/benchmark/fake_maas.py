@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016  Ghent University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# pylint: disable=c0111,c0103
+"""Stand-in for the parts of MAAS that the Sojobo API uses: the users API,
+/accounts/authenticate/ and the login and prefs pages of the web UI.
+
+Every user can log in with any password and gets the API key
+'<username>:token-key:token-secret'. Run with --legacy to act like a MAAS
+without /accounts/authenticate/, so API keys are scraped from the web UI.
+"""
+import argparse
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs
+
+PREFS_PAGE = """<html><body>
+<div id="api"><ul><li><input type="text" value="{}" readonly></li></ul></div>
+</body></html>"""
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMAASHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    legacy = False
+    users = None
+    users_lock = threading.Lock()
+
+    def log_message(self, format, *args): # pylint: disable=w0622
+        pass
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        return {key: values[0] for key, values in form.items()}
+
+    def do_POST(self): # pylint: disable=c0103
+        time.sleep(self.latency)
+        path = self.path.rstrip('/')
+        if path.endswith('/accounts/authenticate') and not self.legacy:
+            username = self.read_form().get('username', '')
+            self.send_json({
+                'consumer_key': username,
+                'token_key': 'token-key',
+                'token_secret': 'token-secret',
+                'name': 'sojobo-api',
+            })
+        elif path.endswith('/api/2.0/users'):
+            user = {'username': self.read_form()['username']}
+            with self.users_lock:
+                self.users.append(user)
+            self.send_json(user)
+        elif path.endswith('/accounts/login'):
+            username = self.read_form().get('username', '')
+            self.send_response(302)
+            self.send_header('Set-Cookie', 'sessionid={}; Path=/'.format(username))
+            self.send_header('Location', self.path.replace('/accounts/login/', '/'))
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def do_GET(self): # pylint: disable=c0103
+        time.sleep(self.latency)
+        if self.path.rstrip('/').endswith('/api/2.0/users'):
+            with self.users_lock:
+                self.send_json(self.users)
+        elif self.path.rstrip('/').endswith('/account/prefs'):
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            if 'sessionid' not in cookie:
+                page = PREFS_PAGE.replace('<input', '<span')
+            else:
+                page = PREFS_PAGE.format('{}:token-key:token-secret'.format(cookie['sessionid'].value))
+            self.send_page(page)
+        else:
+            self.send_page('<html><body>MAAS</body></html>')
+
+    def send_json(self, content):
+        self.send_page(json.dumps(content), 'application/json')
+
+    def send_page(self, page, content_type='text/html; charset=utf-8'):
+        body = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=0, latency=0.05, users=('admin',), legacy=False):
+    """Starts the fake MAAS in a background thread and returns the server.
+    Use port 0 to pick a free port."""
+    handler = type('Handler', (FakeMAASHandler,), {
+        'latency': latency,
+        'legacy': legacy,
+        'users': [{'username': user} for user in users],
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=5240)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds to sleep before every response')
+    parser.add_argument('--users', default='admin', help='comma-separated list of existing users')
+    parser.add_argument('--legacy', action='store_true', help='act like MAAS < 2.2')
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.users.split(','), args.legacy)
+    print('Fake MAAS listening on http://127.0.0.1:{}/MAAS'.format(server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
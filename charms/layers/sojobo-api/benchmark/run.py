@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016  Ghent University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# pylint: disable=c0111,c0103,c0413
+"""Offline benchmark of the Sojobo API.
+
+Puts the fake `juju` command of ./bin on PATH, starts the fake MAAS API and
+web UI and drives the Flask APP of sojobo_api.py with concurrent requests.
+Prints p50/p95/p99 latency and requests per second for every route.
+
+Use --url to benchmark a running API (eg. under gunicorn) instead; that API
+has to be started with the environment printed by --print-env.
+"""
+import argparse
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+import fake_maas
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+SBIN_DIR = os.path.join(BENCH_DIR, '..', 'files', 'sojobo-api', 'sbin')
+USERNAME = 'bench'
+PASSWORD = 'bench'
+ROUTES = [
+    '/',
+    '/users/bench',
+    '/users/bench/models',
+    '/users/bench/models?include=status',
+    '/users/bench/models/m1',
+    '/users/bench/models/m1/status',
+    '/users/bench/models/m1/status?fields=applications.*.units.*.workload-status',
+    '/users/bench/models/m1/applications/app0/config',
+    '/users/bench/credentials.zip',
+    '/metrics',
+]
+
+
+def fake_status(applications, units):
+    """A `juju status --format json` document of the given size."""
+    machines = {}
+    apps = {}
+    for app in range(applications):
+        app_units = {}
+        for unit in range(units):
+            machine = str(len(machines))
+            machines[machine] = {
+                'juju-status': {'current': 'started', 'since': '01 Jan 2016 00:00:00Z', 'version': '2.0.0'},
+                'dns-name': '10.0.{}.{}'.format(app, unit),
+                'instance-id': 'node-{}'.format(machine),
+                'machine-status': {'current': 'running', 'message': 'Deployed', 'since': '01 Jan 2016 00:00:00Z'},
+                'series': 'xenial',
+                'hardware': 'arch=amd64 cpu-cores=4 mem=16384M',
+            }
+            app_units['app{}/{}'.format(app, unit)] = {
+                'workload-status': {'current': 'active', 'message': 'Ready', 'since': '01 Jan 2016 00:00:00Z'},
+                'juju-status': {'current': 'idle', 'since': '01 Jan 2016 00:00:00Z', 'version': '2.0.0'},
+                'machine': machine,
+                'open-ports': ['8080/tcp'],
+                'public-address': '10.0.{}.{}'.format(app, unit),
+            }
+        apps['app{}'.format(app)] = {
+            'charm': 'cs:xenial/app{}-1'.format(app),
+            'series': 'xenial',
+            'exposed': False,
+            'application-status': {'current': 'active', 'message': 'Ready', 'since': '01 Jan 2016 00:00:00Z'},
+            'relations': {},
+            'units': app_units,
+        }
+    return {
+        'model': {'name': 'bench-m1', 'controller': 'bench', 'cloud': 'tengumaas', 'version': '2.0.0'},
+        'machines': machines,
+        'applications': apps,
+    }
+
+
+def setup_environment(args):
+    """Starts the fake MAAS and returns the environment of the API."""
+    workdir = tempfile.mkdtemp(prefix='sojobo-bench-')
+    juju_dir = os.path.join(workdir, '.local', 'share', 'juju')
+    os.makedirs(juju_dir)
+    with open(os.path.join(juju_dir, 'controllers.yaml'), 'w') as c_file:
+        yaml.dump({'controllers': {'bench': {
+            'api-endpoints': ['127.0.0.1:17070'],
+            'ca-cert': '',
+            'uuid': '00000000-0000-0000-0000-000000000000',
+        }}}, c_file)
+    status_path = os.path.join(workdir, 'status.json')
+    with open(status_path, 'w') as s_file:
+        json.dump(fake_status(args.applications, args.units), s_file)
+    maas = fake_maas.serve(latency=args.maas_latency, users=['admin', USERNAME], legacy=args.legacy_maas)
+    return {
+        'HOME': workdir,
+        'PATH': '{}:{}'.format(os.path.join(BENCH_DIR, 'bin'), os.environ['PATH']),
+        'MAAS_USER': 'admin',
+        'MAAS_API_KEY': 'admin:token-key:token-secret',
+        'MAAS_URL': 'http://127.0.0.1:{}/MAAS'.format(maas.server_port),
+        'JUJU_USER': 'admin',
+        'JUJU_PASSWORD': 'admin',
+        'CONTROLLER_NAME': 'bench',
+        'JUJU_BACKEND': 'cli',
+        'FAKE_CLI_LATENCY': str(args.cli_latency),
+        'FAKE_JUJU_STATUS': status_path,
+        'FAKE_JUJU_MODELS': 'controller,bench-m1,bench-m2,bench-m3',
+    }
+
+
+def app_client():
+    """Returns a function that GETs a path from the in-process Flask APP."""
+    sys.path.insert(0, SBIN_DIR)
+    import sojobo_api # pylint: disable=e0401
+    sojobo_api.start_background_jobs()
+    client = sojobo_api.APP.test_client()
+    headers = {
+        'Authorization': 'Basic {}'.format(
+            b64encode('{}:{}'.format(USERNAME, PASSWORD).encode('utf-8')).decode('ascii')),
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+    }
+
+    def get(path):
+        response = client.get(path, headers=headers)
+        response.get_data()
+        return response.status_code
+    return get
+
+
+def url_client(url):
+    """Returns a function that GETs a path from a running API."""
+    import requests
+    session = requests.Session()
+    session.auth = (USERNAME, PASSWORD)
+    session.headers['Accept'] = 'application/json'
+
+    def get(path):
+        response = session.get(url.rstrip('/') + path)
+        return response.status_code
+    return get
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def bench_route(get, path, requests_per_route, concurrency):
+    def timed_get(_):
+        start = time.time()
+        code = get(path)
+        return time.time() - start, code
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_get, range(requests_per_route)))
+    elapsed = time.time() - start
+    latencies = [r[0] for r in results]
+    errors = len([r for r in results if r[1] >= 400])
+    return {
+        'route': path,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'rps': len(results) / elapsed,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--cli-latency', type=float, default=0.5,
+                        help='seconds every fake juju command takes')
+    parser.add_argument('--maas-latency', type=float, default=0.05,
+                        help='seconds every fake MAAS web request takes')
+    parser.add_argument('--legacy-maas', action='store_true',
+                        help='make the fake MAAS act like MAAS < 2.2 so API keys are scraped from the web UI')
+    parser.add_argument('--applications', type=int, default=10, help='applications in the fake status')
+    parser.add_argument('--units', type=int, default=5, help='units per application in the fake status')
+    parser.add_argument('--route', action='append', help='only benchmark these routes')
+    parser.add_argument('--url', help='benchmark the API running at this url')
+    parser.add_argument('--print-env', action='store_true',
+                        help='print the environment for an API started outside this script and wait')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    env = setup_environment(args)
+    if args.print_env:
+        for key, value in sorted(env.items()):
+            print('export {}="{}"'.format(key, value))
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+    os.environ.update(env)
+    get = url_client(args.url) if args.url else app_client()
+    # Warm up: the first request logs in and creates the benchmark user.
+    get('/users/{}'.format(USERNAME))
+
+    results = [bench_route(get, path, args.requests, args.concurrency) for path in args.route or ROUTES]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{:<75} {:>8} {:>8} {:>8} {:>9} {:>6}'.format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errors'))
+    for result in results:
+        print('{route:<75} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {rps:>9.1f} {errors:>6}'.format(
+            route=result['route'], p50=result['p50'] * 1000, p95=result['p95'] * 1000,
+            p99=result['p99'] * 1000, rps=result['rps'], errors=result['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016  Ghent University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# pylint: disable=c0111
+"""gunicorn settings of the Sojobo API. Docs: http://docs.gunicorn.org/en/stable/settings.html"""
+from prometheus_client import multiprocess
+
+
+def post_worker_init(worker): # pylint: disable=w0613
+    # Every worker logs in and runs the periodic jobs in threads of its own.
+    # Imported here, once the worker loaded the app.
+    import sojobo_api # pylint: disable=e0401
+    sojobo_api.start_background_jobs()
+
+
+def child_exit(server, worker): # pylint: disable=w0613
+    # Drop the live gauges of workers that exited.
+    multiprocess.mark_process_dead(worker.pid)
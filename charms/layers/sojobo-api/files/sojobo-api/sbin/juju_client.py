@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016  Ghent University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# pylint: disable=c0111,c0301
+"""Minimal client for the websocket API of a Juju 2.0 controller.
+
+Docs:
+ - https://github.com/juju/juju/blob/master/doc/api.txt
+"""
+from contextlib import contextmanager
+from itertools import count
+import json
+import ssl
+import threading
+import time
+
+import websocket
+import yaml
+
+
+class JujuAPIError(Exception):
+    def __init__(self, message, code=None):
+        super(JujuAPIError, self).__init__(message)
+        self.code = code
+
+
+class Connection(object):
+    """A logged-in websocket connection to a controller or to one model.
+    A connection is not thread-safe; use it through a `ConnectionPool`."""
+    def __init__(self, endpoint, ssl_context, username, password, model_uuid=None, timeout=30):
+        if model_uuid:
+            url = 'wss://{}/model/{}/api'.format(endpoint, model_uuid)
+        else:
+            url = 'wss://{}/api'.format(endpoint)
+        self.model_uuid = model_uuid
+        self.last_used = time.time()
+        self._ids = count(1)
+        self._ws = websocket.create_connection(
+            url,
+            timeout=timeout,
+            sslopt={'context': ssl_context, 'check_hostname': False})
+        self.rpc('Admin', 3, 'Login', {
+            'auth-tag': 'user-{}'.format(username),
+            'credentials': password,
+            'nonce': '',
+        })
+
+    def rpc(self, facade, version, request, params=None):
+        request_id = next(self._ids)
+        self._ws.send(json.dumps({
+            'request-id': request_id,
+            'type': facade,
+            'version': version,
+            'request': request,
+            'params': params or {},
+        }))
+        while True:
+            result = json.loads(self._ws.recv())
+            if result.get('request-id') == request_id:
+                break
+        self.last_used = time.time()
+        if result.get('error'):
+            raise JujuAPIError(result['error'], result.get('error-code'))
+        return result.get('response', {})
+
+    def close(self):
+        try:
+            self._ws.close()
+        except (websocket.WebSocketException, OSError):
+            pass
+
+
+class ConnectionPool(object):
+    """Keeps up to `max_size` idle connections per model. Connections that
+    are idle for more than `idle_timeout` seconds are closed by
+    `evict_idle()`."""
+    def __init__(self, controller, username, password, max_size=4, idle_timeout=300):
+        self.controller = controller
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, model_uuid=None):
+        with self._lock:
+            idle = self._idle.get(model_uuid, [])
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = Connection(
+                self.controller.endpoint, self.controller.ssl_context,
+                self.username, self.password, model_uuid)
+        broken = False
+        try:
+            yield conn
+        except (websocket.WebSocketException, OSError):
+            broken = True
+            raise
+        finally:
+            if broken:
+                conn.close()
+            else:
+                self._release(conn)
+
+    def _release(self, conn):
+        with self._lock:
+            idle = self._idle.setdefault(conn.model_uuid, [])
+            if len(idle) < self.max_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        evicted = []
+        with self._lock:
+            for model_uuid, idle in list(self._idle.items()):
+                evicted.extend(c for c in idle if c.last_used < deadline)
+                idle[:] = [c for c in idle if c.last_used >= deadline]
+                if not idle:
+                    del self._idle[model_uuid]
+        for conn in evicted:
+            conn.close()
+        return len(evicted)
+
+    def close(self):
+        with self._lock:
+            conns = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+class Controller(object):
+    """Endpoint and CA certificate of a controller in `controllers.yaml`."""
+    def __init__(self, name, controllers_path):
+        with open(controllers_path) as c_file:
+            info = yaml.safe_load(c_file)['controllers'][name]
+        self.name = name
+        self.endpoint = info['api-endpoints'][0]
+        # Load the CA certificate from memory instead of a temp file.
+        self.ssl_context = ssl.create_default_context(cadata=info['ca-cert'])
+        # The controller certificate is issued to 'juju-apiserver'.
+        self.ssl_context.check_hostname = False
+
+
+class JujuClient(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self._model_uuids = {}
+
+    def list_models(self, username=None):
+        """Returns a dict that maps the names of the models `username` has
+        access to, by default those of the API user, to their uuid."""
+        with self.pool.connection() as conn:
+            result = conn.rpc('ModelManager', 2, 'ListModels', {
+                'tag': 'user-{}'.format(username or self.pool.username),
+            })
+        models = {
+            m['model']['name']: m['model']['uuid'] for m in result.get('user-models') or []
+        }
+        if username is None:
+            self._model_uuids = models
+        return models
+
+    def model_uuid(self, modelname):
+        uuid = self._model_uuids.get(modelname)
+        if uuid is None:
+            uuid = self.list_models().get(modelname)
+            if uuid is None:
+                raise JujuAPIError('model "{}" not found'.format(modelname), 'not found')
+        return uuid
+
+    def call(self, modelname, facade, version, request, params=None):
+        try:
+            with self.pool.connection(self.model_uuid(modelname)) as conn:
+                return conn.rpc(facade, version, request, params)
+        except (websocket.WebSocketException, OSError):
+            # The model might have been destroyed and recreated.
+            self._model_uuids.pop(modelname, None)
+            raise
+
+    def status(self, modelname):
+        return self.call(modelname, 'Client', 1, 'FullStatus', {'patterns': []})
+
+    def application_get(self, modelname, appname):
+        return self.call(modelname, 'Application', 1, 'Get', {'application': appname})
+
+    def gui_url(self, modelname):
+        return 'https://{}/gui/{}/'.format(self.pool.controller.endpoint, self.model_uuid(modelname))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016  Ghent University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# pylint: disable=c0111,c0301
+"""Client for the MAAS 2.0 REST API over one connection-pooled HTTP session.
+
+Docs:
+ - https://docs.ubuntu.com/maas/2.1/en/api
+ - https://docs.ubuntu.com/maas/2.1/en/manage-cli#api-authentication
+"""
+import time
+import uuid
+
+from lxml import html
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry # pylint: disable=e0401
+
+
+class MAASError(Exception):
+    def __init__(self, message, status_code=None):
+        super(MAASError, self).__init__(message)
+        self.status_code = status_code
+
+
+class MAASClient(object):
+    """Talks to MAAS as the user of `api_key`. Requests are retried on
+    connection errors and on 502, 503 and 504 responses."""
+    def __init__(self, url, api_key, pool_size=10, retries=3, timeout=(5, 30)):
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries, backoff_factor=0.2,
+                status_forcelist=(502, 503, 504), raise_on_status=False))
+        self._session = self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        # Sessions share the adapter and thus the connection pool.
+        session.mount('http://', self._adapter)
+        session.mount('https://', self._adapter)
+        return session
+
+    def _oauth_header(self):
+        consumer_key, token_key, token_secret = self.api_key.split(':')
+        params = [
+            ('oauth_version', '1.0'),
+            ('oauth_signature_method', 'PLAINTEXT'),
+            ('oauth_consumer_key', consumer_key),
+            ('oauth_token', token_key),
+            ('oauth_signature', '&{}'.format(token_secret)),
+            ('oauth_nonce', uuid.uuid4().hex),
+            ('oauth_timestamp', str(int(time.time()))),
+        ]
+        return 'OAuth ' + ', '.join('{}="{}"'.format(k, v) for k, v in params)
+
+    def request(self, method, path, **kwargs):
+        """Sends an OAuth-signed request to the API and returns the decoded
+        JSON response."""
+        kwargs.setdefault('timeout', self.timeout)
+        headers = kwargs.pop('headers', {})
+        headers['Authorization'] = self._oauth_header()
+        response = self._session.request(
+            method, '{}/api/2.0/{}'.format(self.url, path.lstrip('/')),
+            headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise MAASError(
+                '{} {} failed: {} {}'.format(method, path, response.status_code, response.text),
+                response.status_code)
+        return response.json()
+
+    def list_users(self):
+        return [u['username'] for u in self.request('GET', 'users/')]
+
+    def create_user(self, username, email, password, is_superuser=False):
+        return self.request('POST', 'users/', data={
+            'username': username,
+            'email': email,
+            'password': password,
+            'is_superuser': '1' if is_superuser else '0',
+        })
+
+    def get_api_key(self, username, password, consumer='sojobo-api'):
+        """Returns the API key of a user or None if the credentials are
+        wrong. MAAS reuses the token of `consumer`, so repeated calls return
+        the same key."""
+        response = self._session.post(
+            '{}/accounts/authenticate/'.format(self.url),
+            data={'username': username, 'password': password, 'consumer': consumer},
+            timeout=self.timeout)
+        if response.status_code == 404:
+            # MAAS < 2.2 has no authenticate endpoint.
+            return self._get_api_key_from_ui(username, password)
+        if response.status_code in (401, 403):
+            return None
+        if response.status_code >= 400:
+            raise MAASError(
+                'authenticate failed: {} {}'.format(response.status_code, response.text),
+                response.status_code)
+        token = response.json()
+        return '{}:{}:{}'.format(token['consumer_key'], token['token_key'], token['token_secret'])
+
+    def _get_api_key_from_ui(self, username, password):
+        # source: https://stackoverflow.com/questions/11892729/how-to-log-in-to-a-website-using-pythons-requests-module/17633072#17633072
+        # A session of its own: closing it must not close the shared pool.
+        with requests.Session() as session:
+            session.post(
+                '{}/accounts/login/'.format(self.url),
+                data={'username': username, 'password': password},
+                timeout=self.timeout)
+            api_page_response = session.get('{}/account/prefs/'.format(self.url), timeout=self.timeout)
+        tree = html.fromstring(api_page_response.text)
+        api_keys = tree.xpath('//div[@id="api"]//input/@value')
+        return str(api_keys[-1]) if api_keys else None
@@ -16,19 +16,44 @@
 # pylint: disable=c0111,c0301,c0325
 import os
 from os.path import expanduser, dirname, realpath
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import gzip
+import hashlib
+import hmac
+from io import BytesIO
 import json
+import re
 import socket
-import shutil
-from shutil import copy2
 import tempfile
-from subprocess import check_call, check_output, STDOUT, CalledProcessError
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from subprocess import check_output, STDOUT, PIPE, CalledProcessError
 from distutils.util import strtobool
+from xml.sax.saxutils import escape
 
-from lxml import html
-import requests
+from apscheduler.schedulers.background import BackgroundScheduler
 from pygments import highlight, lexers, formatters
-from flask import Flask, Response, request, redirect, send_file
+from flask import Flask, Response, request, redirect, send_file, stream_with_context, g
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST,
+    generate_latest, multiprocess
+)
+import websocket
 import yaml
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from juju_client import Controller, ConnectionPool, JujuClient, JujuAPIError
+from maas_client import MAASClient
 #
 # Init feature flags and global variables
 #
@@ -61,6 +86,28 @@ JUJU_USER = os.environ.get('JUJU_USER')
 JUJU_PASSWORD = os.environ.get('JUJU_PASSWORD')
 CONTROLLER_NAME = os.environ.get('CONTROLLER_NAME')
 CLOUD_NAME = "tengumaas"
+LOGIN_INTERVAL = int(os.environ.get('LOGIN_INTERVAL', 3600))
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 300))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 1024))
+JUJU_BACKEND = os.environ.get('JUJU_BACKEND', 'native')
+JUJU_POOL_SIZE = int(os.environ.get('JUJU_POOL_SIZE', 4))
+JUJU_POOL_IDLE_TIMEOUT = int(os.environ.get('JUJU_POOL_IDLE_TIMEOUT', 300))
+STATUS_MAX_AGE = int(os.environ.get('STATUS_MAX_AGE', 5))
+STATUS_WATCH_TTL = int(os.environ.get('STATUS_WATCH_TTL', 60))
+STREAM_KEEPALIVE = 15
+# Every open stream holds a server thread, so streams get at most this many.
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', 16))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 100))
+JOB_TTL = int(os.environ.get('JOB_TTL', 86400))
+MAX_SUBPROCESSES = int(os.environ.get('MAX_SUBPROCESSES', 8))
+MAAS_POOL_SIZE = int(os.environ.get('MAAS_POOL_SIZE', 10))
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', 8))
+HIGHLIGHT_MAX_SIZE = int(os.environ.get('HIGHLIGHT_MAX_SIZE', 262144))
+COMPRESS_MIN_SIZE = 1024
+CONTROLLERS_PATH = expanduser('~/.local/share/juju/controllers.yaml')
+with open("{}/install_credentials.py".format(dirname(realpath(__file__))), 'rb') as script_file:
+    INSTALL_CREDENTIALS_SCRIPT = script_file.read()
 
 #
 # Init flask
@@ -70,22 +117,302 @@ APP.url_map.strict_slashes = False
 
 
 #
-# schedule periodic re-login
+# Metrics
 #
+# Docs:
+# - https://github.com/prometheus/client_python
+#
+# Under gunicorn, every worker writes its metrics to `prometheus_multiproc_dir`
+# and /metrics aggregates them.
+REQUEST_LATENCY = Histogram(
+    'sojobo_request_duration_seconds', 'Latency of API requests.',
+    ['method', 'route', 'status'])
+COMMAND_LATENCY = Histogram(
+    'sojobo_command_duration_seconds', 'Latency of juju commands.',
+    ['command'], buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')))
+COMMAND_ERRORS = Counter(
+    'sojobo_command_errors_total', 'Number of failed juju commands.',
+    ['command'])
+COMMANDS_IN_FLIGHT = Gauge(
+    'sojobo_commands_in_flight', 'Number of running juju commands.',
+    multiprocess_mode='livesum')
+OPERATION_LATENCY = Histogram(
+    'sojobo_operation_duration_seconds',
+    'Latency of other expensive operations such as Juju API calls, MAAS '
+    'requests and serialization.', ['operation'])
+OPERATION_ERRORS = Counter(
+    'sojobo_operation_errors_total', 'Number of failed operations.',
+    ['operation'])
+
+
+@contextmanager
+def timed(operation):
+    try:
+        with OPERATION_LATENCY.labels(operation).time():
+            yield
+    except Exception:
+        OPERATION_ERRORS.labels(operation).inc()
+        raise
+
 
-def login():
-    print("'LOGIN' START")
-    check_call(['maas', 'login', MAAS_USER, MAAS_URL, MAAS_API_KEY])
-    print(check_output(
-        ['juju', 'login', JUJU_USER, '--controller', CONTROLLER_NAME],
-        input=JUJU_PASSWORD + '\n',
-        universal_newlines=True))
-    print("'LOGIN' FINISHED")
+def command_label(cmd):
+    """'juju status' without user-specific arguments."""
+    return ' '.join(cmd[:2])
 
 
 @APP.before_request
-def initialize():
-    login()
+def start_timer():
+    g.request_start = time.time()
+
+
+@APP.after_request
+def record_request(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(
+            time.time() - g.request_start)
+    return response
+
+
+@APP.route('/metrics')
+def api_metrics():
+    """ Metrics in the Prometheus text format """
+    registry = REGISTRY
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+#
+# schedule periodic re-login
+#
+# Strings in the output of a failed `juju` command that indicate that the
+# session of the API user expired or was never created.
+AUTH_ERRORS = (
+    'not logged in',
+    'please enter password',
+    'invalid entity name or password',
+    'cannot get discharge',
+    'no credentials provided',
+)
+
+
+class SessionManager(object):
+    """Keeps the `juju` CLI session of the API user alive.
+
+    We login once on startup and renew the session every `interval` seconds
+    in the background. When a command fails with an auth error in between, we
+    login again and retry the command once.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.logged_in = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        SCHEDULER.add_job(
+            self.login, 'interval', seconds=self.interval,
+            id='relogin', coalesce=True, max_instances=1)
+        try:
+            self.login()
+        except Exception as exc: # pylint: disable=w0703
+            # The controller may be down; run() logs in on the first command.
+            print("'LOGIN' FAILED: {}".format(exc))
+
+    def login(self, force=True):
+        with self._lock:
+            if self.logged_in and not force:
+                return
+            print("'LOGIN' START")
+            print(run_command(
+                ['juju', 'login', JUJU_USER, '--controller', CONTROLLER_NAME],
+                input=JUJU_PASSWORD + '\n'))
+            self.logged_in = True
+            print("'LOGIN' FINISHED")
+
+    def run(self, cmd, input=None, merge_stderr=False): # pylint: disable=w0622
+        if not self.logged_in:
+            self.login(force=False)
+        try:
+            return run_command(cmd, input=input, merge_stderr=merge_stderr)
+        except CalledProcessError as exc:
+            if not is_auth_error(exc):
+                raise
+            print("'{}' failed with an auth error, logging in again".format(' '.join(cmd[:3])))
+            self.logged_in = False
+            self.login()
+            return run_command(cmd, input=input, merge_stderr=merge_stderr)
+
+
+def run_command(cmd, input=None, merge_stderr=False): # pylint: disable=w0622
+    label = command_label(cmd)
+    try:
+        with SUBPROCESS_SLOTS, COMMANDS_IN_FLIGHT.track_inprogress(), \
+                COMMAND_LATENCY.labels(label).time():
+            return check_output(
+                cmd, input=input, universal_newlines=True,
+                stderr=STDOUT if merge_stderr else PIPE)
+    except CalledProcessError as exc:
+        COMMAND_ERRORS.labels(label).inc()
+        print("'{}' failed: {}{}".format(' '.join(cmd[:3]), exc.output or '', exc.stderr or ''))
+        raise
+
+
+def is_auth_error(exc):
+    output = (exc.output or '') + (exc.stderr or '')
+    return any(err in output for err in AUTH_ERRORS)
+
+
+def cli(cmd, input=None, merge_stderr=False): # pylint: disable=w0622
+    """Runs a `juju` command as the API user and returns stdout."""
+    return SESSION.run(cmd, input=input, merge_stderr=merge_stderr)
+
+
+class SingleFlight(object):
+    """Lets concurrent calls with the same key share one execution: the
+    first caller runs the function, the others wait for and get its result
+    or exception. Shared results must be treated as read-only."""
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.executed = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight.Call()
+                self.executed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'shared': self.shared,
+                'in-flight': len(self._calls),
+            }
+
+
+# Caps the number of `juju` and `maas` processes running at the same time.
+SUBPROCESS_SLOTS = threading.BoundedSemaphore(MAX_SUBPROCESSES)
+# Leaves the other server threads to the regular requests.
+STREAM_SLOTS = threading.BoundedSemaphore(MAX_STREAMS)
+FLIGHTS = SingleFlight()
+SCHEDULER = BackgroundScheduler(daemon=True)
+SESSION = SessionManager(LOGIN_INTERVAL)
+MAAS = MAASClient(MAAS_URL or '', MAAS_API_KEY, pool_size=MAAS_POOL_SIZE)
+STARTUP_LOCK = threading.Lock()
+
+
+def start_background_jobs():
+    """Logs in and starts the periodic jobs. Safe to call more than once.
+    Called by the post_worker_init hook of gunicorn_config.py under gunicorn
+    and before the Flask server starts otherwise."""
+    with STARTUP_LOCK:
+        if SCHEDULER.running:
+            return
+        SESSION.start()
+        JUJU.start()
+        STATUS.start()
+        SCHEDULER.start()
+        atexit.register(SCHEDULER.shutdown, wait=False)
+
+
+#
+# Caches
+#
+
+class TTLCache(object):
+    """Thread-safe dict whose entries expire `ttl` seconds after they were
+    set. When more than `maxsize` entries are stored, the least recently used
+    entry is evicted."""
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Maps a (username, salted password hash) pair to the MAAS API key of that
+# user. A hit means the password was verified against MAAS less than ttl
+# seconds ago.
+AUTH_CACHE = TTLCache(AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
+# Holds the set of existing MAAS users under the key 'users'.
+USERS_CACHE = TTLCache(AUTH_CACHE_TTL, 1)
+# Maps a username to (api key, mtime of controllers.yaml, credentials.zip).
+CREDENTIALS_CACHE = TTLCache(3600, AUTH_CACHE_SIZE)
+# The salt is regenerated on every start so password hashes never leave the
+# process.
+AUTH_SALT = os.urandom(16)
 
 @APP.after_request
 def apply_caching(response):
@@ -96,6 +423,33 @@ def apply_caching(response):
     response.headers['Accept'] = 'application/json'
     return response
 
+@APP.after_request
+def compress(response):
+    """gzip or deflate the response if the client supports it."""
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if (not encoding or
+            response.direct_passthrough or
+            response.is_streamed or
+            not 200 <= response.status_code < 300 or
+            'Content-Encoding' in response.headers or
+            response.mimetype == 'application/zip'):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    if encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=6)
+    else:
+        data = zlib.compress(data, 6)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # The compressed body is no longer byte-identical to the original.
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
 # @APP.errorhandler(JujuNotFoundException)
 # def handle_invalid_usage(error):
 #     return create_response(404, {"msg": 'Cannot find resource. Reason: {}'.format(error.message)})
@@ -120,6 +474,18 @@ def api_icon():
     return redirect("http://tengu.io/assets/icons/favicon.ico", code=302)
 
 
+@APP.route('/caches')
+def api_caches():
+    """ Hit/miss counters of the in-process caches """
+    info = {
+        'auth': AUTH_CACHE.stats(),
+        'users': USERS_CACHE.stats(),
+        'credentials': CREDENTIALS_CACHE.stats(),
+        'single-flight': FLIGHTS.stats(),
+    }
+    return create_response(200, info)
+
+
 @APP.route('/users/<username>', methods=['GET', 'PUT'])
 def create_user(username):
     token = authenticate(request.authorization, username)
@@ -131,6 +497,31 @@ def create_user(username):
     return create_response(200, response)
 
 
+@APP.route('/users/<username>/models', methods=['GET'])
+def list_models(username):
+    token = authenticate(request.authorization, username)
+    if not token:
+        return create_response(403, {'message':"Auth failed! username in auth and in url have to be the same"})
+    prefix = "{}-".format(token.username)
+    models = {}
+    # Only the models the user was granted access to: the prefix alone also
+    # matches the models of eg. 'bob-smith' for 'bob'.
+    for realname in FLIGHTS.do(('models', token.username), JUJU.list_models, token.username):
+        if realname.startswith(prefix):
+            models[realname[len(prefix):]] = {'model-realname': realname}
+    if 'status' in request.args.get('include', '').split(','):
+        futures = {
+            name: BULK_EXECUTOR.submit(STATUS.get, model['model-realname'])
+            for name, model in models.items()
+        }
+        for name, future in futures.items():
+            try:
+                models[name]['status'] = filter_status(future.result()[0])[0]
+            except (CalledProcessError, JujuAPIError, ValueError) as exc:
+                models[name]['error'] = getattr(exc, 'stderr', None) or str(exc)
+    return create_response(200, {'models': models})
+
+
 @APP.route('/users/<username>/models/<modelname>', methods=['GET', 'PUT'])
 def create_model(username, modelname):
     token = authenticate(request.authorization, username, modelname)
@@ -138,7 +529,21 @@ def create_model(username, modelname):
         return create_response(403, {'message':"Auth failed! username in auth and in url have to be the same"})
     if request.method == 'PUT':
         model = request.json
-        juju_create_model(token.username, token.api_key, model['ssh-keys'], token.modelname)
+        try:
+            job = JOBS.submit(
+                token.username, 'create-model', create_model_job,
+                token.username, token.api_key, model['ssh-keys'], token.modelname, modelname)
+        except QueueFullError:
+            response = create_response(503, {'message': "Too many pending jobs, try again later"})
+            response.headers['Retry-After'] = '30'
+            return response
+        response = create_response(202, {
+            'model-realname': token.modelname,
+            'model-prettyname': modelname,
+            'job': job.to_dict(),
+        })
+        response.headers['Location'] = '/jobs/{}'.format(job.id)
+        return response
     response = {
         'model-realname': token.modelname,
         'model-prettyname': modelname,
@@ -147,13 +552,79 @@ def create_model(username, modelname):
     return create_response(200, response)
 
 
+@APP.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = JOBS.get(job_id)
+    if not job:
+        return create_response(404, {'message': "Job {} not found".format(job_id)})
+    token = authenticate(request.authorization, job.username)
+    if not token:
+        return create_response(403, {'message': "Auth failed! Only the owner of a job can see it"})
+    return create_response(200, job.to_dict())
+
+
 @APP.route('/users/<username>/models/<modelname>/status', methods=['GET'])
 def status(username, modelname):
     token = authenticate(request.authorization, username, modelname)
     if not token:
         return create_response(403, {'message':"Auth failed! username in auth and in url have to be the same"})
-    response = juju_status(token)
-    return create_response(200, response)
+    response, etag = STATUS.get(token.modelname)
+    response, etag = filter_status(response, etag)
+    if request.if_none_match.contains_weak(etag):
+        not_modified = Response(status=304)
+        not_modified.set_etag(etag)
+        return not_modified
+    response = create_response(200, response)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    return response
+
+
+@APP.route('/users/<username>/models/<modelname>/status/stream', methods=['GET'])
+def status_stream(username, modelname):
+    """Server-Sent Events stream of the model status: a 'snapshot' event
+    with the full status followed by a 'patch' event with JSON-patch
+    operations each time the status changes. A stream that missed a change
+    gets a new 'snapshot' event. Errors are sent as 'error' events. At most MAX_STREAMS streams are open at the same time."""
+    token = authenticate(request.authorization, username, modelname)
+    if not token:
+        return create_response(403, {'message':"Auth failed! username in auth and in url have to be the same"})
+    realname = token.modelname
+    if not STREAM_SLOTS.acquire(blocking=False):
+        response = create_response(503, {'message': "Too many open status streams, try again later"})
+        response.headers['Retry-After'] = str(STREAM_KEEPALIVE)
+        return response
+
+    def error_event(exc):
+        return sse_event('error', {'message': getattr(exc, 'stderr', None) or str(exc)})
+
+    def events():
+        while True:
+            try:
+                etag, event = STATUS.snapshot_event(realname)
+                break
+            except (CalledProcessError, JujuAPIError, ValueError) as exc:
+                yield error_event(exc)
+                time.sleep(STREAM_KEEPALIVE)
+        yield event
+        while True:
+            try:
+                etag, event = STATUS.next_event(realname, etag, STREAM_KEEPALIVE)
+            except (CalledProcessError, JujuAPIError, ValueError) as exc:
+                yield error_event(exc)
+                time.sleep(STREAM_KEEPALIVE)
+                continue
+            # The events are shared by all streams of the model.
+            yield event or ': keepalive\n\n'
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # Also runs when the client went away before the stream started.
+    response.call_on_close(STREAM_SLOTS.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx and friends not to buffer the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @APP.route('/users/<username>/models/<modelname>/applications/<appname>/config', methods=['GET'])
@@ -162,7 +633,7 @@ def get_config(username, modelname, appname):
     if not token:
         return create_response(403, {'message':"Auth failed! username in auth and in url have to be the same"})
     response = juju_config(token, appname)
-    return create_response(200, response)
+    return create_response(200, project(response, parse_fields(request.args.get('fields'))))
 
 
 @APP.route('/users/<username>/credentials.zip', methods=['GET'])
@@ -189,121 +660,668 @@ def get_credentials(username):
             }
         }
     }
-    controllers = get_controllers(CONTROLLER_NAME)
-    tmpdir = tempfile.mkdtemp()
-    os.mkdir('{}/creds'.format(tmpdir))
-    write_yaml('{}/creds/clouds.yaml'.format(tmpdir), clouds)
-    write_yaml('{}/creds/credentials.yaml'.format(tmpdir), credentials)
-    write_yaml('{}/creds/controllers.yaml'.format(tmpdir), controllers)
-    copy2("{}/install_credentials.py".format(dirname(realpath(__file__))), '{}/creds/install_credentials.py'.format(tmpdir))
-    shutil.make_archive('{}/creds'.format(tmpdir), 'zip', '{}/creds/'.format(tmpdir))
-    return send_file('{}/creds.zip'.format(tmpdir))
+    archive = FLIGHTS.do(
+        ('credentials.zip', token.username), credentials_zip,
+        token.username, token.api_key, credentials, clouds)
+    return send_file(BytesIO(archive), mimetype='application/zip')
+
 
+def credentials_zip(username, api_key, credentials, clouds):
+    """Returns the credentials archive of a user as bytes. The archive is
+    rebuilt when the API key of the user or controllers.yaml changed."""
+    controllers_mtime = os.stat(CONTROLLERS_PATH).st_mtime
+    cached = CREDENTIALS_CACHE.get(username)
+    if cached and cached[0] == api_key and cached[1] == controllers_mtime:
+        return cached[2]
+    buf = BytesIO()
+    with timed('credentials_zip'), zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('clouds.yaml', yaml.dump(clouds))
+        archive.writestr('credentials.yaml', yaml.dump(credentials))
+        archive.writestr('controllers.yaml', yaml.dump(get_controllers(CONTROLLER_NAME)))
+        script = zipfile.ZipInfo('install_credentials.py', time.localtime()[:6])
+        script.compress_type = zipfile.ZIP_DEFLATED
+        script.external_attr = 0o755 << 16
+        archive.writestr(script, INSTALL_CREDENTIALS_SCRIPT)
+    CREDENTIALS_CACHE.set(username, (api_key, controllers_mtime, buf.getvalue()))
+    return buf.getvalue()
 
-def write_yaml(path, content):
-    with open(path, "w") as y_file:
-        y_file.write(yaml.dump(content))
 
 def authenticate(auth, username, modelname=None):
-    if username != auth.username:
+    if not auth or username != auth.username:
         return None
-    if not auth.username in maas_list_users():
-        maas_create_user(auth.username, auth.password)
-        juju_create_user(auth.username, auth.password)
+    cache_key = credentials_cache_key(auth.username, auth.password)
+    api_key = AUTH_CACHE.get(cache_key)
+    if api_key is None:
+        FLIGHTS.do(('ensure-user', auth.username), ensure_user, auth.username, auth.password)
+        api_key = FLIGHTS.do(
+            ('api-key',) + cache_key, maas_get_user_api_key, auth.username, auth.password)
+        if api_key is None:
+            invalidate_credentials(auth.username)
+            return None
+        AUTH_CACHE.set(cache_key, api_key)
     token = Token()
     token.username = auth.username
     token.password = auth.password
-    token.api_key = maas_get_user_api_key(token.username, auth.password)
+    token.api_key = api_key
     if modelname:
         token.modelname = "{}-{}".format(auth.username, modelname)
         token.fqmodelname = "admin/{}".format(token.modelname)
     return token
 
+def credentials_cache_key(username, password):
+    digest = hmac.new(AUTH_SALT, password.encode('utf-8'), hashlib.sha256).hexdigest()
+    return (username, digest)
+
+def invalidate_credentials(username):
+    """Forgets all cached credentials of `username`."""
+    for key in AUTH_CACHE.keys():
+        if key[0] == username:
+            AUTH_CACHE.pop(key)
+    USERS_CACHE.clear()
+
+def ensure_user(username, password):
+    if not maas_user_exists(username):
+        maas_create_user(username, password)
+        juju_create_user(username, password)
+
+def maas_user_exists(username):
+    users = USERS_CACHE.get('users')
+    if users is None or username not in users:
+        users = set(maas_list_users())
+        USERS_CACHE.set('users', users)
+    return username in users
+
 def maas_list_users():
-    users = json.loads(check_output(['maas', MAAS_USER, 'users', 'read'], universal_newlines=True))
-    return [u['username'] for u in users]
+    return FLIGHTS.do('maas-users', _maas_list_users)
+
+def _maas_list_users():
+    with timed('maas_list_users'):
+        return MAAS.list_users()
 
 def maas_create_user(username, password):
     # email has to be unique
-    check_call(['maas', MAAS_USER, 'users', 'create', 'username={}'.format(username), 'email=merlijn.sebrechts+maas-user-{}@gmail.com'.format(username), 'password={}'.format(password), 'is_superuser=0'])
+    with timed('maas_create_user'):
+        MAAS.create_user(username, 'merlijn.sebrechts+maas-user-{}@gmail.com'.format(username), password)
+    USERS_CACHE.clear()
 
 def maas_get_user_api_key(username, password):
-    # source: https://stackoverflow.com/questions/11892729/how-to-log-in-to-a-website-using-pythons-requests-module/17633072#17633072
-    payload = {
-        'username': username,
-        'password': password
-    }
-    with requests.Session() as session:
-        login_response = session.post('{}/accounts/login/'.format(MAAS_URL), data=payload)
-        print(login_response)
-        api_page_response = session.get('{}/account/prefs/'.format(MAAS_URL))
-        print(api_page_response)
-    tree = html.fromstring(api_page_response.text)
-    api_keys = tree.xpath('//div[@id="api"]//input/@value')
-    return str(api_keys[-1])
+    """Returns the API key of the user or None if the password is wrong."""
+    with timed('maas_get_user_api_key'):
+        return MAAS.get_api_key(username, password)
 
 def juju_list_users():
-    users = json.loads(check_output(['juju', 'list-users', '--format', 'json'],
-                                    universal_newlines=True))
+    users = load_json(cli(['juju', 'list-users', '--format', 'json']))
     return [u['user-name'] for u in users]
 
 def juju_create_user(username, password):
-    check_call(['juju', 'add-user', username])
-    check_call(['juju', 'grant', username, 'add-model'])
+    cli(['juju', 'add-user', username])
+    cli(['juju', 'grant', username, 'add-model'])
     output = None
     try:
-        # We need to use check_output here because check_call has no "input" option
-        output = check_output(['juju', 'change-user-password', username],
-                              input="{}\n{}\n".format(password, password),
-                              universal_newlines=True)
+        output = cli(['juju', 'change-user-password', username],
+                     input="{}\n{}\n".format(password, password))
     except CalledProcessError as e:
         output = e.output
     finally:
         print(output)
 
-def juju_create_model(username, api_key, ssh_keys, modelname):
-    credentials = {
-        'credentials': {
-            CLOUD_NAME: {
-                username: {
-                    'auth-type': 'oauth1',
-                    'maas-oauth': api_key,
-                }
-            }
-        }
+def juju_create_model(username, api_key, ssh_keys, modelname, progress=None):
+    JUJU.create_model(username, api_key, ssh_keys, modelname, progress)
+
+
+def create_model_job(job, username, api_key, ssh_keys, modelname, prettyname):
+    juju_create_model(username, api_key, ssh_keys, modelname, job.set_progress)
+    STATUS.invalidate(modelname)
+    job.set_progress('getting gui url')
+    token = Token()
+    token.username = username
+    token.modelname = modelname
+    return {
+        'model-realname': modelname,
+        'model-prettyname': prettyname,
+        'gui-url': juju_get_gui_url(token),
     }
-    tmp = tempfile.NamedTemporaryFile(mode="w+", delete=False)
-    tmp.write(json.dumps(credentials))
-    tmp.close()  # deletes the file
-    modelconfig = []
-    if ssh_keys:
-        modelconfig = modelconfig + ['authorized-keys="{}"'.format(ssh_keys)]
-    if len(modelconfig):
-        modelconfig = ['--config'] + modelconfig
-    check_call(['juju', 'add-credential', '--replace', CLOUD_NAME, '-f', tmp.name])
-    check_call(['juju', 'add-model', modelname, '--credential', username] + modelconfig)
-    check_call(['juju', 'grant', username, 'admin', modelname])
 
 
 def juju_get_gui_url(token):
     modelname = 'controller'
     if token.modelname:
         modelname = token.modelname
-    return check_output(['juju', 'gui', '--no-browser', '--model', modelname], universal_newlines=True, stderr=STDOUT).rstrip()
+    return FLIGHTS.do(('gui-url', modelname), JUJU.gui_url, modelname)
 
 
 def juju_status(token):
-    output = check_output(['juju', 'status', '--format', 'json', '--model', token.modelname], universal_newlines=True)
-    return json.loads(output)
+    return FLIGHTS.do(('status', token.modelname), JUJU.status, token.modelname)
 
 
 def juju_config(token, appname):
-    output = check_output(['juju', 'config', appname, '--model', token.modelname, '--format', 'json'], universal_newlines=True)
-    return json.loads(output)
+    return FLIGHTS.do(('config', token.modelname, appname), JUJU.config, token.modelname, appname)
+
+
+#
+# Juju backends
+#
+
+class SubprocessJujuBackend(object):
+    """Talks to the controller by running the `juju` CLI."""
+    def start(self):
+        pass
+
+    def create_model(self, username, api_key, ssh_keys, modelname, progress=None):
+        progress = progress or (lambda step: None)
+        credentials = {
+            'credentials': {
+                CLOUD_NAME: {
+                    username: {
+                        'auth-type': 'oauth1',
+                        'maas-oauth': api_key,
+                    }
+                }
+            }
+        }
+        tmp = tempfile.NamedTemporaryFile(mode="w+", delete=False)
+        tmp.write(json.dumps(credentials))
+        tmp.close()
+        modelconfig = []
+        if ssh_keys:
+            modelconfig = modelconfig + ['authorized-keys="{}"'.format(ssh_keys)]
+        if len(modelconfig):
+            modelconfig = ['--config'] + modelconfig
+        progress('adding credential')
+        try:
+            cli(['juju', 'add-credential', '--replace', CLOUD_NAME, '-f', tmp.name])
+        finally:
+            os.remove(tmp.name)
+        progress('adding model')
+        cli(['juju', 'add-model', modelname, '--credential', username] + modelconfig)
+        progress('granting access')
+        cli(['juju', 'grant', username, 'admin', modelname])
+
+    def list_models(self, username=None):
+        cmd = ['juju', 'list-models', '--format', 'json']
+        if username:
+            cmd += ['--user', username]
+        output = load_json(cli(cmd))
+        return [m.get('short-name') or m['name'].split('/')[-1] for m in output.get('models', [])]
+
+    def gui_url(self, modelname):
+        output = cli(['juju', 'gui', '--no-browser', '--model', modelname], merge_stderr=True)
+        # Only the URL, like the native backend returns.
+        match = re.search(r'https?://\S+', output)
+        return match.group(0) if match else output.strip()
+
+    def status(self, modelname):
+        output = cli(['juju', 'status', '--format', 'json', '--model', modelname])
+        return load_json(output)
+
+    def config(self, modelname, appname):
+        output = cli(['juju', 'config', appname, '--model', modelname, '--format', 'json'])
+        return load_json(output)
+
+
+class NativeJujuBackend(SubprocessJujuBackend):
+    """Talks to the controller over pooled websocket connections, one pool per
+    model. Falls back to the CLI when the API call fails. Model creation
+    still uses the CLI because it needs the client-side credential store."""
+    def __init__(self, pool_size, idle_timeout):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        SCHEDULER.add_job(
+            self.evict_idle, 'interval', seconds=max(self.idle_timeout // 2, 1),
+            id='juju-pool-evict', coalesce=True, max_instances=1)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                pool = ConnectionPool(
+                    Controller(CONTROLLER_NAME, CONTROLLERS_PATH),
+                    JUJU_USER, JUJU_PASSWORD,
+                    max_size=self.pool_size, idle_timeout=self.idle_timeout)
+                self._client = JujuClient(pool)
+            return self._client
+
+    def evict_idle(self):
+        if self._client:
+            self._client.pool.evict_idle()
+
+    def _fallback(self, method, *args):
+        try:
+            with timed('juju_api_{}'.format(method)):
+                return getattr(self.client, method)(*args)
+        except (JujuAPIError, websocket.WebSocketException, OSError) as exc:
+            print("Juju API call '{}' failed, falling back to the CLI: {}".format(method, exc))
+            return None
+
+    def list_models(self, username=None):
+        models = self._fallback('list_models', username)
+        if models is None:
+            return super(NativeJujuBackend, self).list_models(username)
+        return list(models)
+
+    def gui_url(self, modelname):
+        url = self._fallback('gui_url', modelname)
+        if url is None:
+            return super(NativeJujuBackend, self).gui_url(modelname)
+        return url
+
+    def status(self, modelname):
+        full_status = self._fallback('status', modelname)
+        if full_status is None:
+            return super(NativeJujuBackend, self).status(modelname)
+        return format_status(full_status)
+
+    def config(self, modelname, appname):
+        result = self._fallback('application_get', modelname, appname)
+        if result is None:
+            return super(NativeJujuBackend, self).config(modelname, appname)
+        return {
+            'application': result.get('application'),
+            'charm': result.get('charm'),
+            'settings': result.get('config', {}),
+        }
+
+
+def format_status(full_status):
+    """Converts the result of the FullStatus API call to the layout of
+    `juju status --format json`."""
+    def fmt(status):
+        status = status or {}
+        return {
+            'current': status.get('status'),
+            'message': status.get('info'),
+            'since': status.get('since'),
+            'version': status.get('version'),
+        }
+
+    def fmt_unit(unit):
+        formatted = {
+            'workload-status': fmt(unit.get('workload-status')),
+            'juju-status': fmt(unit.get('agent-status')),
+            'workload-version': unit.get('workload-version'),
+            'machine': unit.get('machine'),
+            'open-ports': unit.get('opened-ports'),
+            'public-address': unit.get('public-address'),
+            'subordinates': {
+                name: fmt_unit(sub) for name, sub in (unit.get('subordinates') or {}).items()
+            },
+        }
+        # `juju status` only shows the leader flag on the leader.
+        if unit.get('leader'):
+            formatted['leader'] = True
+        return formatted
+
+    def fmt_machine(machine):
+        return {
+            'juju-status': fmt(machine.get('agent-status')),
+            'machine-status': fmt(machine.get('instance-status')),
+            'dns-name': machine.get('dns-name'),
+            'instance-id': machine.get('instance-id'),
+            'series': machine.get('series'),
+            'hardware': machine.get('hardware'),
+            'containers': {
+                cid: fmt_machine(container)
+                for cid, container in (machine.get('containers') or {}).items()
+            },
+        }
+
+    model = full_status.get('model') or {}
+    return {
+        'model': {
+            'name': model.get('name'),
+            'controller': CONTROLLER_NAME,
+            'cloud': model.get('cloud'),
+            'version': model.get('version'),
+        },
+        'machines': {
+            mid: fmt_machine(machine) for mid, machine in (full_status.get('machines') or {}).items()
+        },
+        'applications': {
+            name: {
+                'charm': app.get('charm'),
+                'series': app.get('series'),
+                'exposed': app.get('exposed'),
+                'application-status': fmt(app.get('status')),
+                'relations': app.get('relations'),
+                'units': {
+                    uname: fmt_unit(unit) for uname, unit in (app.get('units') or {}).items()
+                },
+            } for name, app in (full_status.get('applications') or {}).items()
+        },
+    }
+
+
+if JUJU_BACKEND == 'native':
+    JUJU = NativeJujuBackend(JUJU_POOL_SIZE, JUJU_POOL_IDLE_TIMEOUT)
+else:
+    JUJU = SubprocessJujuBackend()
+
+
+#
+# Model status cache
+#
+
+class ModelStatus(object):
+    def __init__(self):
+        # (status, etag) is replaced as a whole so readers never see the
+        # ETag of one status together with another status.
+        self.snapshot = (None, None)
+        # SSE events shared by all streams of the model: (old etag, new
+        # etag, 'patch' event) of the last change and (etag, 'snapshot'
+        # event) of the current status.
+        self.patch = (None, None, None)
+        self._snapshot_event = (None, None)
+        self.updated = 0
+        self.last_read = time.time()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition()
+
+    def is_fresh(self, max_age):
+        return self.snapshot[0] is not None and time.time() - self.updated < max_age
+
+    def snapshot_event(self):
+        """Returns the ETag and the 'snapshot' event of the status. The
+        event is built once per status."""
+        status, etag = self.snapshot
+        cached = self._snapshot_event
+        if cached[0] != etag:
+            cached = self._snapshot_event = (etag, sse_event('snapshot', status, etag))
+        return cached
+
+
+class StatusCache(object):
+    """Serves the status of a model from memory.
+
+    A status older than `max_age` seconds is refreshed by the first request
+    that needs it; concurrent requests for the same model wait for that
+    refresh instead of starting their own. Models that were read in the last
+    `watch_ttl` seconds are also refreshed in the background, so polling
+    clients almost never wait for the controller. Models nobody reads
+    anymore are dropped.
+    """
+    def __init__(self, max_age, watch_ttl):
+        self.max_age = max_age
+        self.watch_ttl = watch_ttl
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        SCHEDULER.add_job(
+            self.refresh_watched, 'interval', seconds=max(self.max_age, 1),
+            id='status-refresh', coalesce=True, max_instances=1)
+
+    def _entry(self, modelname):
+        with self._lock:
+            entry = self._models.get(modelname)
+            if entry is None:
+                entry = self._models[modelname] = ModelStatus()
+            return entry
+
+    def get(self, modelname):
+        """Returns the status of the model and its ETag."""
+        entry = self._entry(modelname)
+        entry.last_read = time.time()
+        if not entry.is_fresh(self.max_age):
+            with entry.lock:
+                if not entry.is_fresh(self.max_age):
+                    self._refresh(modelname, entry)
+        return entry.snapshot
+
+    def wait(self, modelname, etag, timeout):
+        """Waits at most `timeout` seconds until the ETag of the model
+        differs from `etag`. Returns the status of the model and its ETag."""
+        entry = self._entry(modelname)
+        entry.last_read = time.time()
+        with entry.changed:
+            if entry.snapshot[1] == etag:
+                entry.changed.wait(timeout)
+        return self.get(modelname)
+
+    def snapshot_event(self, modelname):
+        """Returns the ETag of the status and the 'snapshot' event that
+        starts a stream."""
+        self.get(modelname)
+        return self._entry(modelname).snapshot_event()
+
+    def next_event(self, modelname, etag, timeout):
+        """Waits like `wait()` and returns the new ETag and the event that
+        brings a stream at `etag` up to date: the shared 'patch' event, a
+        'snapshot' event if the stream missed a change, or None if the
+        status did not change."""
+        self.wait(modelname, etag, timeout)
+        entry = self._entry(modelname)
+        old_etag, new_etag, event = entry.patch
+        if old_etag == etag and new_etag == entry.snapshot[1]:
+            return new_etag, event
+        if entry.snapshot[1] == etag:
+            return etag, None
+        return entry.snapshot_event()
+
+    def _refresh(self, modelname, entry):
+        status = FLIGHTS.do(('status', modelname), JUJU.status, modelname)
+        content = json.dumps(status, sort_keys=True).encode('utf-8')
+        etag = hashlib.sha1(content).hexdigest()
+        entry.updated = time.time()
+        if etag != entry.snapshot[1]:
+            old_status, old_etag = entry.snapshot
+            if old_status is not None:
+                # Computed once here instead of in every stream.
+                entry.patch = (old_etag, etag, sse_event('patch', status_patch(old_status, status), etag))
+            entry.snapshot = (status, etag)
+            with entry.changed:
+                entry.changed.notify_all()
+
+    def refresh_watched(self):
+        deadline = time.time() - self.watch_ttl
+        with self._lock:
+            for modelname in [m for m, e in self._models.items() if e.last_read < deadline]:
+                del self._models[modelname]
+            watched = list(self._models.items())
+        for modelname, entry in watched:
+            with entry.lock:
+                try:
+                    self._refresh(modelname, entry)
+                except (CalledProcessError, ValueError) as exc:
+                    print("Refreshing status of '{}' failed: {}".format(modelname, exc))
+
+    def invalidate(self, modelname):
+        with self._lock:
+            entry = self._models.pop(modelname, None)
+        if entry:
+            # Wake up the streams so they pick up the new entry.
+            with entry.changed:
+                entry.changed.notify_all()
+
+
+def filter_status(status, etag=None):
+    """Applies the `application` and `fields` query parameters of the
+    current request to a status. Returns the filtered status and an ETag
+    that is unique for the status and the query."""
+    applications = [a for a in request.args.get('application', '').split(',') if a]
+    fields = parse_fields(request.args.get('fields'))
+    if not applications and not fields:
+        return status, etag
+    if applications:
+        status = dict(status)
+        status['applications'] = {
+            name: app for name, app in (status.get('applications') or {}).items()
+            if name in applications
+        }
+    if etag:
+        query = '{}|{}'.format(','.join(applications), request.args.get('fields', ''))
+        etag = hashlib.sha1('{}|{}'.format(etag, query).encode('utf-8')).hexdigest()
+    return project(status, fields), etag
+
+
+def parse_fields(fields):
+    """Parses 'applications.*.units.*.workload-status,model' into a list of
+    paths."""
+    if not fields:
+        return []
+    return [f.split('.') for f in fields.split(',') if f]
+
+
+def project(obj, paths):
+    """Returns the parts of `obj` selected by `paths`. A path is a list of
+    dict keys where '*' matches every key. An empty list of paths selects
+    everything. `obj` itself is never modified."""
+    if not paths:
+        return obj
+    result = _project(obj, paths)
+    return {} if result is _MISSING else result
+
+
+_MISSING = object()
+
+
+def _project(obj, paths):
+    if any(not path for path in paths):
+        return obj
+    if not isinstance(obj, dict):
+        return _MISSING
+    result = {}
+    for key, value in obj.items():
+        subpaths = [path[1:] for path in paths if path[0] in ('*', key)]
+        if subpaths:
+            selected = _project(value, subpaths)
+            if selected is not _MISSING:
+                result[key] = selected
+    return result or _MISSING
+
+
+def status_patch(old, new, path='', depth=4):
+    """Returns the JSON-patch operations (RFC 6902) that turn status `old`
+    into `new`. Dicts are compared key by key up to `depth` levels deep, eg.
+    down to /applications/<app>/units/<unit>; deeper changes replace the
+    value at that level."""
+    if old == new:
+        return []
+    if depth == 0 or not isinstance(old, dict) or not isinstance(new, dict):
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    ops = []
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'remove', 'path': json_pointer(path, key)})
+    for key, value in new.items():
+        if key not in old:
+            ops.append({'op': 'add', 'path': json_pointer(path, key), 'value': value})
+        else:
+            ops.extend(status_patch(old[key], value, json_pointer(path, key), depth - 1))
+    return ops
+
+
+def json_pointer(path, key):
+    return '{}/{}'.format(path, str(key).replace('~', '~0').replace('/', '~1'))
+
+
+def sse_event(event, data, event_id=None):
+    lines = ['event: {}'.format(event)]
+    if event_id:
+        lines.append('id: {}'.format(event_id))
+    lines.extend('data: {}'.format(line) for line in dump_json(data).splitlines())
+    return '\n'.join(lines) + '\n\n'
+
+
+STATUS = StatusCache(STATUS_MAX_AGE, STATUS_WATCH_TTL)
+# Shared by all bulk requests so the fan-out is bounded across requests.
+BULK_EXECUTOR = ThreadPoolExecutor(max_workers=BULK_WORKERS)
+
+
+#
+# Background jobs
+#
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, username, kind):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.kind = kind
+        self.state = 'queued'
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def set_progress(self, step):
+        self.progress = step
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.kind,
+            'state': self.state,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobQueue(object):
+    """Runs long operations on a bounded pool of worker threads per
+    controller. Finished jobs are kept for `ttl` seconds so clients can poll
+    their result."""
+    def __init__(self, workers, max_pending, ttl):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._jobs = TTLCache(ttl, 10000)
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def _executor(self, controller):
+        executor = self._executors.get(controller)
+        if executor is None:
+            executor = self._executors[controller] = ThreadPoolExecutor(max_workers=self.workers)
+        return executor
+
+    def submit(self, username, kind, func, *args, **kwargs):
+        """Queues `func(job, *args, **kwargs)` on the pool of the controller
+        given by the `controller` keyword and returns the job. The return value
+        of `func` becomes the result of the job."""
+        job = Job(username, kind)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise QueueFullError()
+            self.pending += 1
+            executor = self._executor(kwargs.pop('controller', CONTROLLER_NAME))
+        self._jobs.set(job.id, job)
+        executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        job.state = 'running'
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.state = 'succeeded'
+        except Exception as exc: # pylint: disable=w0703
+            print("Job {} ({}) failed: {}".format(job.id, job.kind, exc))
+            job.error = getattr(exc, 'stderr', None) or getattr(exc, 'output', None) or str(exc)
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                self.pending -= 1
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+
+JOBS = JobQueue(JOB_WORKERS, JOB_MAX_PENDING, JOB_TTL)
 
 
 def get_controllers(name):
-    with open(expanduser('~/.local/share/juju/controllers.yaml'))as c_file:
+    with open(CONTROLLERS_PATH) as c_file:
         c_contents = yaml.safe_load(c_file)
     return {
         'controllers': {
@@ -314,22 +1332,43 @@ def get_controllers(name):
 #
 # Helpers
 #
+HTML_FORMATTER = formatters.HtmlFormatter( #pylint: disable=E1101
+    full=True,
+    title="{} returns:".format(socket.gethostname())
+)
+JSON_LEXER = lexers.JsonLexer() # pylint: disable=E1101
+PLAIN_HTML = """<!DOCTYPE html>
+<html><head><title>{} returns:</title></head><body><pre>{}</pre></body></html>"""
+
+
+def load_json(text):
+    with timed('json_load'):
+        return json.loads(text)
+
+
+def dump_json(obj, indent=None):
+    with timed('json_dump'):
+        if ujson:
+            return ujson.dumps(obj, indent=indent or 0, escape_forward_slashes=False)
+        return json.dumps(obj, indent=indent)
+
+
 def create_response(http_code, return_object):
     if request_wants_json():
         return Response(
-            json.dumps(return_object),
+            dump_json(return_object),
             status=http_code,
             mimetype='application/json',
         )
     else:
-        formatted_json = json.dumps(return_object, indent=4)
-        formatter = formatters.HtmlFormatter( #pylint: disable=E1101
-            full=True,
-            title="{} returns:".format(socket.gethostname())
-        )
-        colorful_json = highlight(formatted_json, lexers.JsonLexer(), formatter) # pylint: disable=E1101
+        formatted_json = dump_json(return_object, indent=4)
+        if len(formatted_json) > HIGHLIGHT_MAX_SIZE:
+            # Highlighting multi-megabyte documents pins a core for seconds.
+            html_json = PLAIN_HTML.format(escape(socket.gethostname()), escape(formatted_json))
+        else:
+            html_json = highlight(formatted_json, JSON_LEXER, HTML_FORMATTER)
         return Response(
-            colorful_json,
+            html_json,
             status=http_code,
             mimetype='text/html',
         )
@@ -353,4 +1392,5 @@ class Token(object):
 # Run flask server when file is executed
 #
 if __name__ == '__main__':
+    start_background_jobs()
     APP.run(host='0.0.0.0', debug=DEBUG, threaded=True)
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # pylint: disable=c0111,c0103,c0301
 import os
+from multiprocessing import cpu_count
 from os.path import expanduser
 import shutil
 import tempfile
@@ -30,7 +31,7 @@ from charmhelpers.core.hookenv import (
     open_port,
     close_port
 )
-from charmhelpers.core.host import service_restart, chownr
+from charmhelpers.core.host import service_restart, service_reload, chownr, file_hash
 from charmhelpers.contrib.python.packages import pip_install
 
 from charms.reactive import hook, when, when_not, set_state
@@ -69,8 +70,15 @@ def install_api():
 
     # Install pip pkgs
     for pkg in ['Jinja2', 'Flask', 'pyyaml', 'click', 'pygments', 'lxml',
-                'apscheduler']:
+                'apscheduler', 'websocket-client', 'gunicorn',
+                'prometheus_client']:
         pip_install(pkg)
+    # Optional speedups, the API works without them.
+    for pkg in ['ujson']:
+        try:
+            pip_install(pkg)
+        except subprocess.CalledProcessError:
+            log('Could not install optional package {}'.format(pkg))
 
     # Install The Sojobo API. Existing /etc files don't get overwritten.
     if os.path.isdir(API_DIR + '/etc'):
@@ -82,15 +90,20 @@ def install_api():
         mergecopytree('files/sojobo-api', API_DIR)
 
     # setup api
-    render_api_systemd_template()
+    unit_changed = render_api_systemd_template()
     # USER should get all access rights.
     chownr(API_DIR, USER, USER, chowntopdir=True)
     subprocess.check_call(['systemctl', 'enable', 'sojobo-api'])
-    restart_api()
+    if unit_changed or config()['server'] != 'gunicorn':
+        restart_api()
+    else:
+        reload_api()
     status_set('active', 'Ready')
 
 
 def render_api_systemd_template():
+    """Renders the systemd unit of the API. Returns True if the unit
+    changed."""
     appconf = config()
     env_vars = [
         "MAAS_USER={}".format(appconf['maas-user']),
@@ -99,23 +112,59 @@ def render_api_systemd_template():
         "JUJU_USER={}".format(appconf['juju-username']),
         "JUJU_PASSWORD={}".format(appconf['juju-password']),
         "CONTROLLER_NAME={}".format(appconf['juju-controller']),
+        "LOGIN_INTERVAL={}".format(appconf['login-interval']),
+        "AUTH_CACHE_TTL={}".format(appconf['auth-cache-ttl']),
+        "AUTH_CACHE_SIZE={}".format(appconf['auth-cache-size']),
+        "JUJU_BACKEND={}".format(appconf['juju-backend']),
+        "JUJU_POOL_SIZE={}".format(appconf['juju-pool-size']),
+        "JUJU_POOL_IDLE_TIMEOUT={}".format(appconf['juju-pool-idle-timeout']),
+        "STATUS_MAX_AGE={}".format(appconf['status-max-age']),
+        "STATUS_WATCH_TTL={}".format(appconf['status-watch-ttl']),
+        "JOB_WORKERS={}".format(appconf['job-workers']),
+        "JOB_MAX_PENDING={}".format(appconf['job-max-pending']),
+        "MAX_SUBPROCESSES={}".format(appconf['max-subprocesses']),
+        "HIGHLIGHT_MAX_SIZE={}".format(appconf['highlight-max-size']),
+        "BULK_WORKERS={}".format(appconf['bulk-workers']),
+        "MAX_STREAMS={}".format(appconf['max-streams']),
     ]
 
     flags = appconf['feature-flags'].replace(' ', '')
     flags = [x for x in flags.split(',') if x != '']
+    if appconf['server'] == 'gunicorn':
+        # Caches, jobs and the Juju login live in each worker, so one worker
+        # with many threads is the default.
+        workers = appconf['workers'] or cpu_count()
+        threads = appconf['threads'] or 32
+        command = (
+            "/usr/local/bin/gunicorn --chdir {0}/sbin --bind 0.0.0.0:5000 "
+            "--config {0}/sbin/gunicorn_config.py "
+            "--workers {1} --threads {2} --worker-class gthread "
+            "--timeout 120 --graceful-timeout 30 sojobo_api:APP".format(API_DIR, workers, threads))
+        reload_command = "/bin/kill -s HUP $MAINPID"
+        # Workers share their metrics through this directory. systemd
+        # creates it on start and removes it on stop.
+        env_vars.append("prometheus_multiproc_dir=/run/sojobo-api")
+    else:
+        command = "{}/sbin/sojobo_api.py".format(API_DIR)
+        reload_command = None
+    unit_path = '/etc/systemd/system/sojobo-api.service'
+    old_hash = file_hash(unit_path)
     templating.render(
         source='flask-app.service',
-        target='/etc/systemd/system/sojobo-api.service',
+        target=unit_path,
         context={
             'description': "The Sojobo API",
             'application_dir': API_DIR,
-            'application_path': "{}/sbin/sojobo_api.py".format(API_DIR),
+            'runtime_dir': 'sojobo-api',
+            'command': command,
+            'reload_command': reload_command,
             'user': USER,
             'flags': flags,
             'env_vars': env_vars,
         }
     )
     subprocess.check_call(['systemctl', 'daemon-reload'])
+    return file_hash(unit_path) != old_hash
 
 
 ###############################################################################
@@ -126,8 +175,8 @@ def render_api_systemd_template():
 
 
 @when('api.installed')
-@when('config.changed.feature-flags')
-def feature_flags_changed():
+@when('config.changed')
+def config_changed():
     render_api_systemd_template()
     restart_api()
 
@@ -141,6 +190,15 @@ def restart_api():
     open_port('5000')
 
 
+def reload_api():
+    """Gracefully replaces the gunicorn workers; in-flight requests finish
+    on the old workers."""
+    service_reload('sojobo-api', restart_on_failure=True)
+    sleep(5)
+    subprocess.check_call(['systemctl', 'is-active', 'sojobo-api'])
+    open_port('5000')
+
+
 
 ###############################################################################
 #